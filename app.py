@@ -1,32 +1,152 @@
 from dotenv import load_dotenv
 load_dotenv()
 
+import atexit
+import bisect
+import csv
+import functools
+import hashlib
+import io
+import itertools
 import json
-import sqlite3
+import multiprocessing
 import os
-import razorpay
-from flask import send_from_directory
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
 from datetime import datetime, timedelta
+
+import click
+import razorpay
+import requests
 from flask import (
     Flask, render_template, request, redirect, url_for,
-    session, send_file, flash
-) 
-from werkzeug.security import generate_password_hash, check_password_hash
+    session, send_file, send_from_directory, flash, g, has_request_context, jsonify,
+    stream_with_context, template_rendered, before_render_template
+)
+from PIL import Image
+from rapidfuzz import fuzz as rapid_fuzz
+from rapidfuzz import process as rapid_process
+from reportlab.lib.colors import black, lightgrey
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from cache import TTLCache
+from catalog import CATALOG_ARTIFACT, Disease, DiseaseCatalog, compile_catalog
+from storage import (
+    DIGEST_RE, SCREENSHOT_CHUNK, SCREENSHOT_MAX_BYTES, THUMBNAIL_PLACEHOLDER,
+    process_screenshot, remove_quietly, screenshot_path, sniff_image_type,
+    store_screenshot, thumbnail_path
+)
+from symptom_index import PHRASE_MATCHING, get_symptom_index, match_symptoms, rank_positions_legacy
+from tokenizer import content_words
 
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
+
+# ---------------- METRICS ----------------
+# Latency buckets in seconds (Prometheus "le" bounds)
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram, cheap enough to sit on the hot path."""
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        slot = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.counts[slot] += 1
+            self.total += seconds
+            self.count += 1
+
+
+class MetricsRegistry:
+    """Per-process histograms keyed by (metric name, label value), rendered as Prometheus text."""
+
+    HELP = {
+        "healmatrix_stage_seconds": ("stage", "Time spent in each /predict pipeline stage."),
+        "healmatrix_request_seconds": ("endpoint", "Request latency by Flask endpoint."),
+    }
+
+    def __init__(self):
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register_collector(self, collect):
+        """Add a callable returning extra exposition lines (counters, gauges)."""
+        self._collectors.append(collect)
+
+    def histogram(self, name, label):
+        key = (name, label)
+        hist = self._histograms.get(key)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(key, Histogram())
+        return hist
+
+    def observe(self, name, label, seconds):
+        self.histogram(name, label).observe(seconds)
+
+    def render(self):
+        lines = []
+        for name in sorted({n for n, _ in self._histograms}):
+            label_name, help_text = self.HELP.get(name, ("label", name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (n, label), hist in sorted(self._histograms.items()):
+                if n != name:
+                    continue
+                with hist._lock:
+                    counts, total, count = list(hist.counts), hist.total, hist.count
+                cumulative = 0
+                for bound, bucket_count in zip(hist.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{label_name}="{label}",le="+Inf"}} {count}')
+                lines.append(f'{name}_sum{{{label_name}="{label}"}} {total}')
+                lines.append(f'{name}_count{{{label_name}="{label}"}} {count}')
+        for collect in self._collectors:
+            lines.extend(collect())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+def timed_stage(stage):
+    """Decorator recording the wrapped function's duration under healmatrix_stage_seconds."""
+    def decorator(fn):
+        hist = metrics.histogram("healmatrix_stage_seconds", stage)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
 
 
 # ---------------- EMERGENCY CHECK SYSTEM ----------------
 
 # ---------------- ADVANCED AI EMERGENCY ENGINE ----------------
 
-from fuzzywuzzy import fuzz
-from rapidfuzz import fuzz as rapid_fuzz
-
 EMERGENCY_SYMPTOMS = {
     "chest pain": {
         "msg": "Chest pain may indicate heart or lung emergency.",
@@ -74,7 +194,24 @@ EMERGENCY_SYMPTOMS = {
     }
 }
 
+EMERGENCY_THRESHOLD = 70  # fuzzy matching threshold
+
+
+def classify_risk(risk_level):
+    if risk_level >= 90:
+        return "HIGH"
+    elif risk_level >= 60:
+        return "MEDIUM"
+    return "LOW"
+
+
+@timed_stage("ai_emergency_check")
 def ai_emergency_check(text):
+    return emergency_detector.check(text)
+
+
+def ai_emergency_check_legacy(text):
+    """Original one-partial_ratio-per-phrase scan, kept as the reference path."""
     text = text.lower()
     risk_level = 0
     triggered = []
@@ -82,19 +219,43 @@ def ai_emergency_check(text):
     for symptom, info in EMERGENCY_SYMPTOMS.items():
         similarity = rapid_fuzz.partial_ratio(symptom, text)
 
-        if similarity > 70:  # fuzzy matching threshold
+        if similarity > EMERGENCY_THRESHOLD:
             triggered.append(info["msg"])
             risk_level = max(risk_level, info["risk"])
 
-    # CLASSIFY RISK LEVEL
-    if risk_level >= 90:
-        level = "HIGH"
-    elif risk_level >= 60:
-        level = "MEDIUM"
-    else:
-        level = "LOW"
+    return triggered, classify_risk(risk_level)
+
+
+class EmergencyDetector:
+    """Scores every EMERGENCY_SYMPTOMS phrase against the text in one rapidfuzz extract call."""
 
-    return triggered, level
+    def __init__(self, phrases):
+        self.phrases = list(phrases)
+        self.infos = [phrases[p] for p in self.phrases]
+
+    def check(self, text):
+        text = text.lower()
+        hits = []
+        if text:
+            matches = rapid_process.extract(
+                text, self.phrases,
+                scorer=rapid_fuzz.partial_ratio,
+                score_cutoff=EMERGENCY_THRESHOLD,
+                limit=None
+            )
+            hits = [pid for _, score, pid in matches if score > EMERGENCY_THRESHOLD]
+
+        risk_level = 0
+        triggered = []
+        for pid in sorted(hits):
+            info = self.infos[pid]
+            triggered.append(info["msg"])
+            risk_level = max(risk_level, info["risk"])
+
+        return triggered, classify_risk(risk_level)
+
+
+emergency_detector = EmergencyDetector(EMERGENCY_SYMPTOMS)
 
 
 # ---------------- DAILY HEALTH TIPS ----------------
@@ -118,27 +279,39 @@ def get_daily_tip():
 
 # ------------------ OFFLINE AI ENGINE (UNLIMITED SYMPTOMS) ------------------
 
-from fuzzywuzzy import fuzz
+@timed_stage("clean_text")
+def clean_text(text):
+    return content_words(text)
 
-import os
 
-def clean_text(text):
-    text = text.lower()
-    words = word_tokenize(text)
-    words = [w for w in words if w.isalpha() and w not in stop_words]
-    return words
+def ai_predict(text_input, diseases, backend=None):
+    ranked = ai_predict_top(text_input, diseases, k=1, backend=backend)
+    if not ranked:
+        return None, -1
+    return ranked[0]
+
+
+def ai_predict_top(text_input, diseases, k=3, backend=None):
+    """Return the k best (disease, score) pairs, best first; ties keep catalog order."""
+    return rank_diseases(clean_text(text_input), diseases, k, backend)
+
 
+@timed_stage("ai_predict")
+def rank_diseases(user_symptoms, diseases, k=3, backend=None):
+    """ai_predict_top for input that has already been through clean_text."""
+    return [(diseases[position], score) for position, score in rank_positions(user_symptoms, diseases, k, backend)]
 
-def match_symptoms(user_symptoms, disease_sym_list):
-    score = 0
-    for u in user_symptoms:
-        for d in disease_sym_list:
-            similarity = fuzz.partial_ratio(u, d)
-            score = max(score, similarity)
-    return score
 
+def rank_positions(user_symptoms, diseases, k=3, backend=None):
+    """Like rank_diseases, but returns (catalog position, score) pairs."""
+    backend = backend or SCORING_BACKEND
+    if backend == "legacy":
+        return rank_positions_legacy(user_symptoms, diseases, k)
+    return get_symptom_index(diseases, backend).top_matches(user_symptoms, k)
 
-def ai_predict(text_input, diseases):
+
+def ai_predict_legacy(text_input, diseases):
+    """Original disease x symptom x token scan, kept as the reference path."""
     user_symptoms = clean_text(text_input)
 
     best_match = None
@@ -155,17 +328,25 @@ def ai_predict(text_input, diseases):
     return best_match, best_score
 
 
+def rank_diseases_legacy(user_symptoms, diseases, k=3):
+    return [(diseases[position], score) for position, score in rank_positions_legacy(user_symptoms, diseases, k)]
+
+
 # ----- Config -----
 APP_DIR = os.path.dirname(__file__)
 
-nltk.data.path.append(os.path.join(APP_DIR, "nltk_data"))
+# Disease scoring backend: "index" (default), "cdist" (vectorized rapidfuzz)
+# or "legacy" (original nested loop). TOKENIZER, PHRASE_MATCHING and
+# SCORING_WORKERS are read by tokenizer.py and symptom_index.py.
+SCORING_BACKEND = os.getenv("SCORING_BACKEND", "index")
 
-try:
-    stop_words = set(stopwords.words("english"))
-except LookupError:
-    stop_words = set()
+# Number of ranked candidates shown on the result page (best + differentials)
+PREDICTION_TOP_K = int(os.getenv("PREDICTION_TOP_K", "3"))
+# Runners-up scoring below this are left out of the differential list
+# (score 0 means no symptom matched at all)
+DIFFERENTIAL_MIN_SCORE = int(os.getenv("DIFFERENTIAL_MIN_SCORE", "1"))
 
-DB_PATH = os.path.join(APP_DIR, "appdata.db")
+DB_PATH = os.getenv("DB_PATH", os.path.join(APP_DIR, "appdata.db"))
 REPORTS_DIR = os.path.join(APP_DIR, "reports")
 if not os.path.exists(REPORTS_DIR):
     os.makedirs(REPORTS_DIR)
@@ -177,16 +358,162 @@ ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 
 app.secret_key = os.getenv("SECRET_KEY")
 
-# ----- Load diseases -----
-with open(os.path.join(APP_DIR, "diseases.json"), "r", encoding="utf-8") as f:
-    DISEASES = json.load(f)
+# ----- Disease catalog -----
+
+DISEASES_PATH = os.path.join(APP_DIR, "diseases.json")
+CATALOG_LOG_PATH = os.path.join(APP_DIR, "diseases.log")
+
+disease_catalog = DiseaseCatalog(DISEASES_PATH, CATALOG_LOG_PATH)
+disease_catalog.snapshot()
+
+
+# ----- Serving mode & executors -----
+
+# "sync": one request at a time per gunicorn worker, everything runs inline.
+# "threaded": gthread workers (gunicorn.conf.py makes this the default), so
+#   requests waiting on I/O only hold one of several threads.
+# SCORING_PROCESSES > 0 (threaded mode only) moves uncached scoring into a
+# per-worker process pool, off the GIL the request threads share. It is off
+# by default: each pool costs a forkserver plus that many full app processes
+# per worker, far more memory than cached sub-millisecond scoring is worth on
+# a small instance.
+# The I/O thread pool (screenshot processing) is used in both modes.
+SERVING_MODE = os.getenv("SERVING_MODE", "sync")
+SCORING_PROCESSES = int(os.getenv("SCORING_PROCESSES", "0"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "4"))
+
+
+class WorkerExecutors:
+    """Per-worker pools, created on first use in the worker that needs them
+    (never in the gunicorn master) and re-created after a fork."""
+
+    def __init__(self, io_workers, scoring_processes):
+        self.io_workers = io_workers
+        self.scoring_processes = scoring_processes
+        self._pid = None
+        self._io = None
+        self._scoring = None
+        self._lock = threading.Lock()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._io = self._scoring = None
+
+    def io(self):
+        with self._lock:
+            self._check_pid()
+            if self._io is None:
+                self._io = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="io")
+            return self._io
+
+    def scoring(self):
+        with self._lock:
+            self._check_pid()
+            if self._scoring is None:
+                # forking a threaded worker is unsafe, so scoring processes
+                # come from a clean forkserver that has imported the app once
+                ctx = multiprocessing.get_context("forkserver")
+                ctx.set_forkserver_preload([__name__])
+                self._scoring = ProcessPoolExecutor(max_workers=self.scoring_processes, mp_context=ctx)
+            return self._scoring
+
+    def reset_scoring(self):
+        with self._lock:
+            self._scoring = None
+
+
+executors = WorkerExecutors(IO_WORKERS, SCORING_PROCESSES)
+
+
+def _rank_in_process(user_symptoms, k):
+    """Runs in a scoring process, against that process's own catalog copy."""
+    return disease_catalog.digest, rank_positions(user_symptoms, disease_catalog.snapshot(), k)
+
+
+def offload_scoring():
+    """Whether scoring goes to executors.scoring() from this process."""
+    return (SERVING_MODE == "threaded" and SCORING_PROCESSES >= 1
+            and multiprocessing.parent_process() is None)
+
+
+_offloaded_predict_hist = metrics.histogram("healmatrix_stage_seconds", "ai_predict")
+
+
+def rank_offloaded(user_symptoms, diseases, k):
+    """rank_diseases, in the scoring pool when offload_scoring() allows it."""
+    if not offload_scoring():
+        return rank_diseases(user_symptoms, diseases, k)
+    start = time.perf_counter()
+    try:
+        digest, ranked = executors.scoring().submit(_rank_in_process, list(user_symptoms), k).result()
+    except BrokenProcessPool:
+        executors.reset_scoring()
+        return rank_diseases(user_symptoms, diseases, k)
+    # the child's own timing never reaches this worker's /metrics
+    _offloaded_predict_hist.observe(time.perf_counter() - start)
+    if digest != disease_catalog.digest:
+        # the catalog changed between the two processes' stat() calls
+        return rank_diseases(user_symptoms, diseases, k)
+    return [(diseases[position], score) for position, score in ranked]
+
+
+def _log_background_failure(future):
+    if future.exception() is not None:
+        app.logger.error("background task failed", exc_info=future.exception())
+
+
+# ----- Prediction result cache -----
+PREDICTION_CACHE_SIZE = int(os.getenv("PREDICTION_CACHE_SIZE", "2048"))
+PREDICTION_CACHE_TTL = float(os.getenv("PREDICTION_CACHE_TTL", "600"))
+
+
+# ranked predictions, keyed on the catalog version and the cleaned token set
+prediction_cache = TTLCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL)
+# emergency results, keyed on the lowercased text (the detector works on the
+# raw text, so word order and phrasing matter there)
+emergency_cache = TTLCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL)
+_prediction_cache_version = None
+
+
+def predict_cached(text_input, k=3):
+    """ai_predict_top over the live catalog, memoized per cleaned token set and catalog version."""
+    global _prediction_cache_version
+    diseases, version = disease_catalog.snapshot_with_version()
+    if version != _prediction_cache_version:
+        prediction_cache.clear()
+        _prediction_cache_version = version
+
+    user_symptoms = clean_text(text_input)
+    # without phrase matching only the token set matters; with it, word order
+    # decides which phrases are found
+    tokens_key = tuple(user_symptoms) if PHRASE_MATCHING else frozenset(user_symptoms)
+    key = (version, SCORING_BACKEND, PHRASE_MATCHING, k, tokens_key)
+    ranked = prediction_cache.get(key)
+    if ranked is None:
+        ranked = tuple(rank_offloaded(user_symptoms, diseases, k))
+        prediction_cache.put(key, ranked)
+    return list(ranked)
+
+
+def emergency_check_cached(text_input):
+    key = text_input.lower()
+    result = emergency_cache.get(key)
+    if result is None:
+        warnings, level = ai_emergency_check(text_input)
+        result = (tuple(warnings), level)
+        emergency_cache.put(key, result)
+    return list(result[0]), result[1]
 
 # ----- Database helpers -----
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
 
-    cur.execute("""
+# Schema migrations, applied in order at startup. The number of migrations
+# already applied is stored in PRAGMA user_version, so only new entries run.
+# Never edit an entry once it has shipped; append a new one instead.
+SCHEMA_MIGRATIONS = [
+    # 1: base tables
+    (
+        """
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE,
@@ -198,9 +525,8 @@ def init_db():
             security_question TEXT,
             security_answer TEXT
         )
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS queries (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -209,9 +535,8 @@ def init_db():
             predicted TEXT,
             health_score INTEGER
         )
-    """)
-
-    cur.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS payments (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -220,50 +545,398 @@ def init_db():
             timestamp TEXT,
             status TEXT DEFAULT 'PENDING'
         )
-    """)
+        """,
+    ),
+    # 2: indexes for per-user history/report lookups and payment review
+    (
+        # /history: WHERE user_id = ? ORDER BY timestamp
+        "CREATE INDEX IF NOT EXISTS idx_queries_user_timestamp ON queries (user_id, timestamp)",
+        # download_report / latest query: WHERE user_id = ? ORDER BY id DESC
+        "CREATE INDEX IF NOT EXISTS idx_queries_user_id ON queries (user_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_user ON payments (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_status_id ON payments (status, id)",
+    ),
+    # 3: admin dashboard aggregates, kept current by triggers so /admin never
+    # scans users or payments; backfilled from existing rows
+    (
+        """
+        CREATE TABLE IF NOT EXISTS user_plan_counts (
+            plan TEXT PRIMARY KEY,
+            users INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS payment_totals (
+            day TEXT NOT NULL,
+            plan TEXT NOT NULL,
+            status TEXT NOT NULL,
+            payments INTEGER NOT NULL DEFAULT 0,
+            amount INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, plan, status)
+        )
+        """,
+        """
+        INSERT INTO user_plan_counts (plan, users)
+        SELECT COALESCE(plan, 'FREE'), COUNT(*) FROM users GROUP BY 1
+        """,
+        """
+        INSERT INTO payment_totals (day, plan, status, payments, amount)
+        SELECT COALESCE(substr(timestamp, 1, 10), ''), COALESCE(plan, ''), COALESCE(status, 'PENDING'),
+               COUNT(*), COALESCE(SUM(amount), 0)
+        FROM payments GROUP BY 1, 2, 3
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO user_plan_counts (plan, users) VALUES (COALESCE(NEW.plan, 'FREE'), 1)
+            ON CONFLICT (plan) DO UPDATE SET users = users + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE user_plan_counts SET users = users - 1 WHERE plan = COALESCE(OLD.plan, 'FREE');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_users_count_plan AFTER UPDATE OF plan ON users
+        WHEN COALESCE(OLD.plan, 'FREE') IS NOT COALESCE(NEW.plan, 'FREE')
+        BEGIN
+            UPDATE user_plan_counts SET users = users - 1 WHERE plan = COALESCE(OLD.plan, 'FREE');
+            INSERT INTO user_plan_counts (plan, users) VALUES (COALESCE(NEW.plan, 'FREE'), 1)
+            ON CONFLICT (plan) DO UPDATE SET users = users + 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_payments_totals_insert AFTER INSERT ON payments
+        BEGIN
+            INSERT INTO payment_totals (day, plan, status, payments, amount)
+            VALUES (COALESCE(substr(NEW.timestamp, 1, 10), ''), COALESCE(NEW.plan, ''),
+                    COALESCE(NEW.status, 'PENDING'), 1, COALESCE(NEW.amount, 0))
+            ON CONFLICT (day, plan, status) DO UPDATE
+            SET payments = payments + 1, amount = amount + excluded.amount;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_payments_totals_delete AFTER DELETE ON payments
+        BEGIN
+            UPDATE payment_totals
+            SET payments = payments - 1, amount = amount - COALESCE(OLD.amount, 0)
+            WHERE day = COALESCE(substr(OLD.timestamp, 1, 10), '') AND plan = COALESCE(OLD.plan, '')
+              AND status = COALESCE(OLD.status, 'PENDING');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_payments_totals_update
+        AFTER UPDATE OF amount, plan, status, timestamp ON payments
+        BEGIN
+            UPDATE payment_totals
+            SET payments = payments - 1, amount = amount - COALESCE(OLD.amount, 0)
+            WHERE day = COALESCE(substr(OLD.timestamp, 1, 10), '') AND plan = COALESCE(OLD.plan, '')
+              AND status = COALESCE(OLD.status, 'PENDING');
+            INSERT INTO payment_totals (day, plan, status, payments, amount)
+            VALUES (COALESCE(substr(NEW.timestamp, 1, 10), ''), COALESCE(NEW.plan, ''),
+                    COALESCE(NEW.status, 'PENDING'), 1, COALESCE(NEW.amount, 0))
+            ON CONFLICT (day, plan, status) DO UPDATE
+            SET payments = payments + 1, amount = amount + excluded.amount;
+        END
+        """,
+    ),
+    # 4: content hash of the payment screenshot (see store_screenshot); the
+    # index finds other payments that reuse the same image
+    (
+        "ALTER TABLE payments ADD COLUMN screenshot TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_payments_screenshot ON payments (screenshot)",
+    ),
+]
 
-    conn.commit()
+
+def migrate(conn):
+    """Apply pending SCHEMA_MIGRATIONS, one transaction per version."""
+    for version, statements in enumerate(SCHEMA_MIGRATIONS, start=1):
+        # BEGIN IMMEDIATE serializes workers that start at the same time
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            current = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current >= version:
+                conn.rollback()
+                continue
+            for sql in statements:
+                conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def init_db():
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate(conn)
     conn.close()
 
 
+# ----- Connection pool -----
+
+# Per-connection tuning; journal_mode=WAL is persistent and set in init_db.
+SQLITE_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-8000",        # 8 MB page cache
+    "PRAGMA mmap_size=67108864",      # 64 MB
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=ON",
+)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
+DB_STATEMENT_CACHE = 256
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            _db_execute_hist.observe(time.perf_counter() - start)
+
+    def executemany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            _db_execute_hist.observe(time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection that records statement and commit times in the stage metrics."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _db_commit_hist.observe(time.perf_counter() - start)
+
+
+_db_execute_hist = metrics.histogram("healmatrix_stage_seconds", "db_execute")
+_db_commit_hist = metrics.histogram("healmatrix_stage_seconds", "db_commit")
+
+
+def _connect():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,
+        factory=TimedConnection
+    )
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class ConnectionPool:
+    """Small per-worker pool of tuned SQLite connections, created lazily and dropped after a fork."""
+
+    def __init__(self, size):
+        self.size = size
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue(maxsize=self.size)
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return _connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+
+
 def get_db_conn():
-    return sqlite3.connect(DB_PATH)
+    """This request's connection; outside a request, a new one the caller owns."""
+    if not has_request_context():
+        return _connect()
+    if "db_conn" not in g:
+        g.db_conn = db_pool.acquire()
+    return g.db_conn
+
+
+@app.teardown_request
+def release_db_conn(exc):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        db_pool.release(conn)
 
 # init DB on startup
 init_db()
 
-# ----- Utility functions -----
 
-def save_query(user_id, symptoms_list, predicted_name):
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO queries (user_id, timestamp, symptoms, predicted) VALUES (?, ?, ?, ?)",
-        (user_id, datetime.utcnow().isoformat(), ",".join(symptoms_list), predicted_name or "")
-    )
-    save_query(
-    user_id,
-    text_input.split(),
-    disease["name"]
-    )
+# ----- Request timing, /metrics and admin profiling -----
 
-    cur.execute("""
-        UPDATE queries
-        SET health_score = ?
-        WHERE id = (SELECT MAX(id) FROM queries WHERE user_id=?)
-    """, (health_score, user_id))
+# /metrics is for a logged-in admin or a scraper sending "Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+PROFILE_HEADER = "X-Profile"
+PROFILE_INTERVAL = 0.005
+PROFILE_KEEP = 20
 
 
-    conn.commit()
-    conn.close()
+class StackSampler:
+    """Samples one thread's stack every few ms into collapsed-stack (flamegraph) text."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    def _run(self):
+        while True:
+            self._sample()
+            if self._stop.wait(self.interval):
+                break
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+
+# finished profiles, newest last: (profile id, endpoint, collapsed stacks)
+profiles = deque(maxlen=PROFILE_KEEP)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if request.headers.get(PROFILE_HEADER) == "1" and session.get("admin_logged_in"):
+        g.profiler = StackSampler(threading.get_ident()).start()
+
+
+@app.after_request
+def record_request_time(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        metrics.observe("healmatrix_request_seconds", request.endpoint or "unknown",
+                        time.perf_counter() - start)
+
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.stop()
+        profile_id = f"{int(time.time() * 1000)}-{os.getpid()}"
+        profiles.append((profile_id, request.endpoint, profiler.collapsed()))
+        response.headers["X-Profile-Id"] = profile_id
+    return response
+
 
-def generate_pdf_report(username, name, age, gender, symptoms, predicted):
-    from reportlab.lib.colors import lightgrey, black
-    from reportlab.lib.units import inch
+def _template_start(sender, template, context, **extra):
+    g.template_start = time.perf_counter()
 
-    timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-    filename = f"report_{username}_{timestamp}.pdf"
-    path = os.path.join(REPORTS_DIR, filename)
+
+def _template_done(sender, template, context, **extra):
+    start = g.pop("template_start", None)
+    if start is not None:
+        metrics.observe("healmatrix_stage_seconds", "render_template", time.perf_counter() - start)
+
+
+before_render_template.connect(_template_start, app)
+template_rendered.connect(_template_done, app)
+
+
+def _cache_metrics():
+    lines = []
+    for name, kind, help_text in (
+        ("healmatrix_cache_hits_total", "counter", "Result cache hits."),
+        ("healmatrix_cache_misses_total", "counter", "Result cache misses."),
+        ("healmatrix_cache_entries", "gauge", "Entries currently in the result cache."),
+        ("healmatrix_cache_hit_rate", "gauge", "Hits / lookups since start."),
+    ):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache_name, cache in (
+            ("prediction", prediction_cache),
+            ("emergency", emergency_cache),
+            ("entitlement", entitlement_cache),
+        ):
+            stats = cache.stats()
+            value = {
+                "healmatrix_cache_hits_total": stats["hits"],
+                "healmatrix_cache_misses_total": stats["misses"],
+                "healmatrix_cache_entries": stats["size"],
+                "healmatrix_cache_hit_rate": stats["hit_rate"],
+            }[name]
+            lines.append(f'{name}{{cache="{cache_name}"}} {value}')
+    return lines
+
+
+metrics.register_collector(_cache_metrics)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    scraper = METRICS_TOKEN and request.headers.get("Authorization") == f"Bearer {METRICS_TOKEN}"
+    if not scraper and not session.get("admin_logged_in"):
+        return "Unauthorized", 401
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/profiles/<profile_id>")
+def admin_profile(profile_id):
+    if not session.get("admin_logged_in"):
+        return redirect("/admin_login")
+    for pid, endpoint, collapsed in profiles:
+        if pid == profile_id:
+            return app.response_class(collapsed, mimetype="text/plain")
+    return "Profile not found (it may have been recorded by another worker)", 404
+
+# ----- Utility functions -----
+
+@timed_stage("generate_pdf_report")
+def generate_pdf_report(username, name, age, gender, symptoms, predicted, path=None):
+    """Draw the report into path (a filename or binary file object, default a new file in REPORTS_DIR)."""
+    if path is None:
+        timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+        filename = f"report_{username}_{timestamp}.pdf"
+        path = os.path.join(REPORTS_DIR, filename)
 
     c = canvas.Canvas(path, pagesize=A4)
     width, height = A4
@@ -333,18 +1006,21 @@ def generate_pdf_report(username, name, age, gender, symptoms, predicted):
     c.setFont("Helvetica-Bold", 14)
     c.drawString(55, y-30, "Predicted Disease Information")
 
-    if isinstance(predicted, dict):
+    if isinstance(predicted, Mapping) and not isinstance(predicted, Disease):
+        predicted = Disease.from_dict(predicted)
+
+    if isinstance(predicted, Disease):
         c.setFont("Helvetica", 11)
-        c.drawString(55, y-55, f"Disease Name: {predicted.get('name','')}")
-        c.drawString(55, y-75, f"Severity: {predicted.get('severity','')}")
-        c.drawString(55, y-95, f"Medicine: {predicted.get('medicine','')}")
+        c.drawString(55, y-55, f"Disease Name: {predicted.name or ''}")
+        c.drawString(55, y-75, f"Severity: {predicted.severity or ''}")
+        c.drawString(55, y-95, f"Medicine: {predicted.medicine or ''}")
 
         c.setFont("Helvetica-Bold", 12)
         c.drawString(55, y-120, "Precautions:")
 
         c.setFont("Helvetica", 11)
         py = y - 138
-        for line in wrap_text(predicted.get("precautions",""), 85):
+        for line in wrap_text(predicted.precautions or "", 85):
             c.drawString(70, py, line)
             py -= 14
     else:
@@ -378,26 +1054,346 @@ def wrap_text(text, max_len):
         lines.append(cur)
     return lines
 
+# ----- Report cache & background rendering -----
+
+# "disk": cached files in REPORTS_DIR rendered in the background (default)
+# "memory": render into a BytesIO per request, nothing is written to disk
+REPORT_STORAGE = os.getenv("REPORT_STORAGE", "disk")
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "2"))
+REPORT_CACHE_MAX_BYTES = int(os.getenv("REPORT_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+REPORT_CACHE_MAX_AGE = int(os.getenv("REPORT_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+# jobs remembered per worker (pending or failed; finished ones are dropped)
+REPORT_JOBS_MAX = 1024
+
+
+def report_cache_key(user_id, username, query_id, predicted):
+    """Content address of a report: same user, query and disease data -> same PDF."""
+    if isinstance(predicted, Mapping):
+        predicted = dict(predicted)
+    payload = json.dumps([user_id, username, query_id, predicted], sort_keys=True, default=list)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def render_pdf_bytes(*report_args):
+    """Render a report fully in memory and return the PDF bytes."""
+    buffer = io.BytesIO()
+    generate_pdf_report(*report_args, path=buffer)
+    return buffer.getvalue()
+
+
+def report_cache_path(key):
+    return os.path.join(REPORTS_DIR, f"report_{key}.pdf")
+
+
+def evict_reports():
+    """Drop reports older than REPORT_CACHE_MAX_AGE, then the least recently
+    used ones until the directory fits in REPORT_CACHE_MAX_BYTES."""
+    now = time.time()
+    entries = []
+    for entry in os.scandir(REPORTS_DIR):
+        if not entry.is_file():
+            continue
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        # leftover partial renders are only removed once clearly abandoned
+        is_partial = ".tmp" in entry.name
+        max_age = 3600 if is_partial else REPORT_CACHE_MAX_AGE
+        if now - st.st_mtime > max_age:
+            remove_quietly(entry.path)
+        elif not is_partial:
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= REPORT_CACHE_MAX_BYTES:
+            break
+        remove_quietly(path)
+        total -= size
+
+
+class ReportRenderer:
+    """Renders PDF reports on a background thread pool, keyed by report cache key."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._executor = None
+        self._pid = None
+        self._jobs = OrderedDict()     # key -> Future, this worker only
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # created lazily so the pool lives in the gunicorn worker, not the master
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="report")
+            self._pid = os.getpid()
+            self._jobs = OrderedDict()
+        return self._executor
+
+    def submit(self, key, *report_args):
+        """Start rendering unless the report is cached or already in progress."""
+        with self._lock:
+            executor = self._get_executor()
+            job = self._jobs.get(key)
+            if job is None or (job.done() and job.exception() is not None):
+                self._jobs[key] = executor.submit(self._render, key, report_args)
+                self._jobs.move_to_end(key)
+                while len(self._jobs) > REPORT_JOBS_MAX:
+                    self._jobs.popitem(last=False)
+        return key
+
+    def _render(self, key, report_args):
+        final_path = report_cache_path(key)
+        tmp_path = f"{final_path}.tmp{os.getpid()}_{threading.get_ident()}"
+        try:
+            generate_pdf_report(*report_args, path=tmp_path)
+            os.replace(tmp_path, final_path)
+        finally:
+            remove_quietly(tmp_path)
+        # the file now answers status(); only failures stay in _jobs
+        with self._lock:
+            self._jobs.pop(key, None)
+        evict_reports()
+        return final_path
+
+    def status(self, key):
+        """'ready', 'pending', 'error' or 'missing' (unknown to this worker)."""
+        if os.path.exists(report_cache_path(key)):
+            return "ready"
+        job = self._jobs.get(key)
+        if job is None:
+            return "missing"
+        if not job.done():
+            return "pending"
+        if job.exception() is not None:
+            return "error"
+        return "ready"
+
+
+report_renderer = ReportRenderer(REPORT_WORKERS)
+
+
+# ----- User entitlements -----
+# free_uses / plan / plan_expiry per user, cached per worker. Writes in this
+# worker update the cached entry directly; changes made by other workers are
+# picked up when the entry expires.
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))
+ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "30"))
+
+
+class Entitlement(namedtuple("Entitlement", "free_uses plan plan_expiry")):
+    """A user's quota and plan; plan_expiry is already parsed (or None)."""
+
+    __slots__ = ()
+
+    def has_active_plan(self):
+        if self.plan == "FREE" or self.plan_expiry is None:
+            return False
+        return datetime.utcnow() <= self.plan_expiry
+
+
+entitlement_cache = TTLCache(ENTITLEMENT_CACHE_SIZE, ENTITLEMENT_CACHE_TTL)
+NO_ENTITLEMENT = Entitlement(0, "FREE", None)
+
+
+def get_entitlement(user_id):
+    entitlement = entitlement_cache.get(user_id)
+    if entitlement is None:
+        conn = get_db_conn()
+        row = conn.execute(
+            "SELECT free_uses, plan, plan_expiry FROM users WHERE id=?", (user_id,)
+        ).fetchone()
+        if not row:
+            return NO_ENTITLEMENT
+        free_uses, plan, expiry = row
+        entitlement = Entitlement(free_uses, plan, datetime.fromisoformat(expiry) if expiry else None)
+        entitlement_cache.put(user_id, entitlement)
+    return entitlement
+
+
+def update_entitlement(user_id, **changes):
+    """Write-through after a users UPDATE: patch the cached entry, if any."""
+    entitlement_cache.update(user_id, lambda entitlement: entitlement._replace(**changes))
+
+
 def has_active_plan(user_id):
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT plan, plan_expiry FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
+    return get_entitlement(user_id).has_active_plan()
+
+
+# ----- Query history write-behind -----
+
+# "sync": the history row is inserted and committed inside the /predict
+#   request, together with the quota decrement.
+# "buffered": rows are queued in the worker and written in batches, one
+#   transaction per QUERY_LOG_BATCH rows or QUERY_LOG_FLUSH_MS, whichever
+#   comes first. The quota decrement itself is still committed before the
+#   response. Pending rows are flushed on graceful worker shutdown; a crash
+#   loses at most the last QUERY_LOG_FLUSH_MS of history. Pages that read
+#   history flush this worker's buffer first; rows queued by another worker
+#   show up within QUERY_LOG_FLUSH_MS.
+QUERY_LOG_MODE = os.getenv("QUERY_LOG_MODE", "buffered")
+QUERY_LOG_BATCH = int(os.getenv("QUERY_LOG_BATCH", "64"))
+QUERY_LOG_FLUSH_MS = int(os.getenv("QUERY_LOG_FLUSH_MS", "200"))
+# past this many queued rows, requests write their own row synchronously
+QUERY_LOG_MAX_PENDING = int(os.getenv("QUERY_LOG_MAX_PENDING", "10000"))
+# PRAGMA synchronous for the flush connection: FULL, NORMAL or OFF
+QUERY_LOG_SYNCHRONOUS = os.getenv("QUERY_LOG_SYNCHRONOUS", "NORMAL").upper()
+
+INSERT_QUERY_SQL = """
+    INSERT INTO queries (user_id, timestamp, symptoms, predicted, health_score)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+
+class QueryLogWriter:
+    """Per-worker write-behind buffer for query history rows."""
+
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pid = None
+        self._rows = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._flush_requested = False
+        self._queued = 0        # rows appended since start
+        self._written = 0       # rows committed (or dropped after a failed write)
+        self._failures = 0
+        self._flush_hist = metrics.histogram("healmatrix_stage_seconds", "query_log_flush")
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._rows = []
+            self._thread = None
+            self._closed = False
+            self._queued = self._written = 0
+
+    def append(self, row, conn):
+        """Queue one row; insert it on conn instead when the buffer is full
+        or the flush thread is gone."""
+        with self._cond:
+            self._check_pid()
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+                self._thread.start()
+            # a dead flush thread would never write them: go synchronous
+            if (not self._closed and len(self._rows) < self.max_pending
+                    and self._thread.is_alive()):
+                self._rows.append(row)
+                self._queued += 1
+                if len(self._rows) >= self.batch_size:
+                    self._cond.notify_all()
+                return
+        conn.execute(INSERT_QUERY_SQL, row)
+        conn.commit()
+
+    def flush(self, timeout=5.0):
+        """Block until every row queued in this worker so far is written."""
+        with self._cond:
+            if self._pid != os.getpid() or self._written >= self._queued:
+                return True
+            if self._thread is None or not self._thread.is_alive():
+                return False
+            target = self._queued
+            self._flush_requested = True
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._written >= target, timeout)
+
+    def close(self):
+        """Flush what is pending and stop the flush thread (worker shutdown)."""
+        with self._cond:
+            if self._pid != os.getpid() or self._thread is None:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        thread.join()
+
+    def pending(self):
+        with self._cond:
+            return len(self._rows) if self._pid == os.getpid() else 0
+
+    def _run(self):
+        # never let an exception end the thread: rows that can't be written
+        # are counted and logged, and the connection is reopened next time
+        conn = None
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: len(self._rows) >= self.batch_size or self._flush_requested or self._closed,
+                    self.flush_interval,
+                )
+                rows, self._rows = self._rows, []
+                self._flush_requested = False
+                closed = self._closed
+            if rows:
+                start = time.perf_counter()
+                try:
+                    if conn is None:
+                        conn = _connect()
+                        conn.execute(f"PRAGMA synchronous={QUERY_LOG_SYNCHRONOUS}")
+                    self._write(conn, rows)
+                except Exception:
+                    app.logger.exception("dropping %d query history rows", len(rows))
+                    self._failures += len(rows)
+                    if conn is not None:
+                        try:
+                            conn.close()
+                        except sqlite3.Error:
+                            pass
+                        conn = None
+                finally:
+                    self._flush_hist.observe(time.perf_counter() - start)
+                    with self._cond:
+                        self._written += len(rows)
+                        self._cond.notify_all()
+            if closed and not rows:
+                break
+        if conn is not None:
+            conn.close()
+
+    def _write(self, conn, rows):
+        try:
+            conn.executemany(INSERT_QUERY_SQL, rows)
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            # one retry row by row, so a single bad row can't sink the batch
+            for row in rows:
+                try:
+                    conn.execute(INSERT_QUERY_SQL, row)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    self._failures += 1
+                    app.logger.exception("dropping query history row for user %s", row[0])
+
+    def stats(self):
+        with self._cond:
+            return {"pending": len(self._rows), "written": self._written, "failures": self._failures}
 
-    if not row:
-        return False
 
-    plan, expiry = row
+query_log = QueryLogWriter(QUERY_LOG_BATCH, QUERY_LOG_FLUSH_MS / 1000, QUERY_LOG_MAX_PENDING)
+atexit.register(query_log.close)
 
-    if plan == "FREE":
-        return False
 
-    if expiry:
-        expiry_date = datetime.fromisoformat(expiry)
-        return datetime.utcnow() <= expiry_date
+def _query_log_metrics():
+    stats = query_log.stats()
+    return [
+        "# HELP healmatrix_query_log_pending Query history rows waiting to be written.",
+        "# TYPE healmatrix_query_log_pending gauge",
+        f"healmatrix_query_log_pending {stats['pending']}",
+        "# HELP healmatrix_query_log_failures_total Query history rows dropped after a failed write.",
+        "# TYPE healmatrix_query_log_failures_total counter",
+        f"healmatrix_query_log_failures_total {stats['failures']}",
+    ]
 
-    return False
+
+metrics.register_collector(_query_log_metrics)
 
 
 
@@ -425,7 +1421,6 @@ def register():
                 VALUES (?, ?, ?, ?)
             """, (username, pw_hash, security_question, sec_ans_hash))
             conn.commit()
-            conn.close()
 
             flash("Account created successfully! Please login.", "success")
             return redirect(url_for("login"))
@@ -447,7 +1442,6 @@ def login():
         cur = conn.cursor()
         cur.execute("SELECT id, password_hash, plan FROM users WHERE username = ?", (username,))
         row = cur.fetchone()
-        conn.close()
 
         if row and check_password_hash(row[1], password):
             session["user_id"] = row[0]
@@ -479,13 +1473,7 @@ def index():
     free_uses = 0
 
     if user_id:
-        conn = get_db_conn()
-        cur = conn.cursor()
-        cur.execute("SELECT free_uses FROM users WHERE id=?", (user_id,))
-        row = cur.fetchone()
-        conn.close()
-
-        free_uses = row[0] if row else 0
+        free_uses = get_entitlement(user_id).free_uses
 
     daily_tip = get_daily_tip()
 
@@ -504,77 +1492,160 @@ def download_report():
         flash("You must be logged in to download reports", "error")
         return redirect(url_for("login"))
     # create a report for last saved query by this user
+    query_log.flush()   # the prediction just made may still be queued
     conn = get_db_conn()
     cur = conn.cursor()
-    cur.execute("SELECT symptoms, predicted, timestamp FROM queries WHERE user_id = ? ORDER BY id DESC LIMIT 1", (session["user_id"],))
+    cur.execute("SELECT id, symptoms, predicted, timestamp FROM queries WHERE user_id = ? ORDER BY id DESC LIMIT 1", (session["user_id"],))
     row = cur.fetchone()
-    conn.close()
     if not row:
         flash("No history found to generate report", "error")
         return redirect(url_for("index"))
-    symptoms_csv, predicted_name, timestamp = row
+    query_id, symptoms_csv, predicted_name, timestamp = row
     symptoms = symptoms_csv.split(",") if symptoms_csv else []
     # find predicted object if exists
-    predicted_obj = None
-    for d in DISEASES:
-        if d.get("name") == predicted_name:
-            predicted_obj = d
-            break
-    # create PDF
-    pdf_path = generate_pdf_report(
-    session.get("username"),
-    session.get("username"),
-    "N/A",
-    "N/A",
-    symptoms,
-    predicted_obj or predicted_name
-)
-    return send_file(pdf_path, as_attachment=True)
+    predicted = disease_catalog.find(predicted_name) or predicted_name
+    username = session.get("username")
+
+    download_name = f"report_{username}.pdf"
+
+    # the cache key doubles as a strong ETag: a browser that already has this
+    # exact report gets a 304 without anything being rendered or read
+    key = report_cache_key(session["user_id"], username, query_id, predicted)
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+        response.set_etag(key)
+        return response
+
+    report_args = (username, username, "N/A", "N/A", symptoms, predicted)
+
+    if REPORT_STORAGE == "memory":
+        pdf_bytes = render_pdf_bytes(*report_args)
+        response = app.response_class(pdf_bytes, mimetype="application/pdf")
+        response.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+        response.set_etag(key)
+        return response
+
+    # serve straight from the report cache when this exact report exists
+    pdf_path = report_cache_path(key)
+    if os.path.exists(pdf_path):
+        os.utime(pdf_path)     # keep recently used reports out of eviction
+        return send_file(pdf_path, as_attachment=True, download_name=download_name, etag=key)
+
+    # otherwise render in the background and let the page poll for it
+    report_renderer.submit(key, *report_args)
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({
+            "job": key,
+            "status": "pending",
+            "status_url": url_for("report_status", job=key)
+        }), 202
+
+    return render_template("report_pending.html", job=key), 202
+
+
+@app.route("/report_status/<job>")
+def report_status(job):
+    if "user_id" not in session:
+        return jsonify({"error": "login required"}), 401
+
+    status = report_renderer.status(job)
+    result = {"job": job, "status": status}
+    if status == "ready":
+        result["url"] = url_for("download_report")
+    return jsonify(result)
 
 
 
 # ----- User history page -----
+HISTORY_PAGE_SIZE = 20
+SCORE_SERIES_MAX_DAYS = 90
+
+
 @app.route("/history")
 def history():
     if "user_id" not in session:
         flash("Please login to see history", "error")
         return redirect(url_for("login"))
 
+    # keyset pagination on (timestamp, id): the cursor is the last row shown
+    after_ts = request.args.get("after_ts")
+    after_id = request.args.get("after_id", type=int)
+
+    query_log.flush()
     conn = get_db_conn()
     cur = conn.cursor()
 
-    cur.execute("""
-        SELECT timestamp, symptoms, predicted, health_score 
-        FROM queries 
-        WHERE user_id = ? 
-        ORDER BY timestamp ASC
-    """, (session["user_id"],))
+    if after_ts is not None and after_id is not None:
+        cur.execute("""
+            SELECT id, timestamp, symptoms, predicted, health_score
+            FROM queries
+            WHERE user_id = ? AND (timestamp, id) > (?, ?)
+            ORDER BY timestamp ASC, id ASC
+            LIMIT ?
+        """, (session["user_id"], after_ts, after_id, HISTORY_PAGE_SIZE + 1))
+    else:
+        cur.execute("""
+            SELECT id, timestamp, symptoms, predicted, health_score
+            FROM queries
+            WHERE user_id = ?
+            ORDER BY timestamp ASC, id ASC
+            LIMIT ?
+        """, (session["user_id"], HISTORY_PAGE_SIZE + 1))
 
     rows = cur.fetchall()
-    conn.close()
+    has_more = len(rows) > HISTORY_PAGE_SIZE
+    rows = rows[:HISTORY_PAGE_SIZE]
 
     history = []
-    dates = []
-    scores = []
-
     for r in rows:
         history.append({
-            "timestamp": r[0],
-            "symptoms": r[1].split(","),
-            "predicted": r[2],
-            "health_score": r[3]
+            "timestamp": r[1],
+            "symptoms": (r[2] or "").split(","),
+            "predicted": r[3],
+            "health_score": r[4]
         })
 
-        dates.append(r[0][:10])  
-        scores.append(r[3])
+    next_page = None
+    if has_more:
+        next_page = url_for("history", after_ts=rows[-1][1], after_id=rows[-1][0])
 
     return render_template(
         "history.html",
         history=history,
-        dates=dates,
-        scores=scores
+        next_page=next_page,
+        first_page=after_id is None
     )
 
+
+@app.route("/history/scores")
+def history_scores():
+    """Daily average health score over the last `days` days (at most SCORE_SERIES_MAX_DAYS)."""
+    if "user_id" not in session:
+        return jsonify({"error": "login required"}), 401
+
+    days = min(max(request.args.get("days", SCORE_SERIES_MAX_DAYS, type=int), 1), SCORE_SERIES_MAX_DAYS)
+    # a lower bound on timestamp range-scans idx_queries_user_timestamp
+    # instead of grouping the user's whole history
+    since = (datetime.utcnow() - timedelta(days=days - 1)).date().isoformat()
+
+    query_log.flush()
+    conn = get_db_conn()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT substr(timestamp, 1, 10) AS day, ROUND(AVG(health_score)) AS score
+        FROM queries
+        WHERE user_id = ? AND timestamp >= ? AND health_score IS NOT NULL
+        GROUP BY day
+        ORDER BY day ASC
+    """, (session["user_id"], since))
+    rows = cur.fetchall()
+
+    return jsonify({
+        "dates": [r[0] for r in rows],
+        "scores": [int(r[1]) for r in rows]
+    })
+
 @app.route("/admin_login", methods=["GET", "POST"])
 def admin_login():
     if request.method == "POST":
@@ -592,36 +1663,99 @@ def admin_login():
 
 
 
+# ----- Admin dashboard -----
+ADMIN_PAGE_SIZE = 50
+ADMIN_REVENUE_DAYS = 14
+
+
+def admin_summary(conn):
+    """Dashboard numbers from the trigger-maintained summary tables
+    (migration 3): a handful of rows, whatever the size of users/payments."""
+    users_by_plan = {
+        plan: count for plan, count in conn.execute(
+            "SELECT plan, users FROM user_plan_counts WHERE users > 0 ORDER BY plan"
+        )
+    }
+    revenue_by_plan = {}
+    pending_payments = 0
+    for plan, status, payments, amount in conn.execute("""
+        SELECT plan, status, SUM(payments), SUM(amount)
+        FROM payment_totals
+        GROUP BY plan, status
+    """):
+        if status == "APPROVED":
+            revenue_by_plan[plan] = revenue_by_plan.get(plan, 0) + amount
+        elif status == "PENDING":
+            pending_payments += payments
+    since = (datetime.utcnow() - timedelta(days=ADMIN_REVENUE_DAYS - 1)).date().isoformat()
+    revenue_by_day = conn.execute("""
+        SELECT day, SUM(payments), SUM(amount)
+        FROM payment_totals
+        WHERE status = 'APPROVED' AND day >= ?
+        GROUP BY day
+        ORDER BY day DESC
+    """, (since,)).fetchall()
+    return {
+        "total_users": sum(users_by_plan.values()),
+        "users_by_plan": users_by_plan,
+        "total_revenue": sum(revenue_by_plan.values()),
+        "revenue_by_plan": revenue_by_plan,
+        "plans": sorted(set(users_by_plan) | set(revenue_by_plan)),
+        "pending_payments": pending_payments,
+        "revenue_days": ADMIN_REVENUE_DAYS,
+        "revenue_by_day": [{"day": d, "payments": n, "amount": a} for d, n, a in revenue_by_day],
+    }
+
+
+def prefix_bounds(prefix):
+    """(lo, hi) such that lo <= s < hi exactly when s starts with prefix."""
+    return prefix, prefix + "\U0010ffff"
+
+
 @app.route("/admin")
 def admin():
     if not session.get("admin_logged_in"):
         return redirect("/admin_login")
 
-    conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT username FROM users")
-    user_rows = cur.fetchall()
-    conn.close()
+    # username search (prefix, case-sensitive) with keyset pagination: the
+    # cursor is the last username shown
+    search = request.args.get("q", "").strip()
+    after = request.args.get("after")
 
-    users = [{"username": u[0], "email": "Hidden"} for u in user_rows]
+    lo, hi = prefix_bounds(search)
+    where = ["username >= ?", "username < ?"]
+    params = [lo, hi]
+    if after is not None:
+        where.append("username > ?")
+        params.append(after)
 
-    # Load diseases
-    with open("diseases.json") as f:
-        diseases = json.load(f)
-
-    # Load total revenue
     conn = get_db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT SUM(amount) FROM payments")
-    total_revenue = cur.fetchone()[0] or 0
-    conn.close()
-
-    # RETURN (correct indent)
+    rows = conn.execute(f"""
+        SELECT username, plan
+        FROM users
+        WHERE {" AND ".join(where)}
+        ORDER BY username
+        LIMIT ?
+    """, (*params, ADMIN_PAGE_SIZE + 1)).fetchall()
+
+    has_more = len(rows) > ADMIN_PAGE_SIZE
+    rows = rows[:ADMIN_PAGE_SIZE]
+    users = [{"username": r[0], "plan": r[1], "email": "Hidden"} for r in rows]
+
+    next_page = None
+    if has_more:
+        next_page = url_for("admin", q=search or None, after=rows[-1][0])
+
+    summary = admin_summary(conn)
     return render_template(
         "admin.html",
         users=users,
-        diseases=diseases,
-        total_revenue=total_revenue
+        diseases=disease_catalog.snapshot(),
+        summary=summary,
+        total_revenue=summary["total_revenue"],
+        search=search,
+        next_page=next_page,
+        first_page=after is None
     )
 
 
@@ -638,13 +1772,7 @@ def add_disease():
         "precautions": request.form["precautions"]
     }
 
-    with open("diseases.json") as f:
-        diseases = json.load(f)
-
-    diseases.append(new_disease)
-
-    with open("diseases.json", "w") as f:
-        json.dump(diseases, f, indent=4)
+    disease_catalog.add(new_disease)
 
     return redirect("/admin")
 
@@ -653,13 +1781,7 @@ def delete_disease(name):
     if not session.get("admin_logged_in"):
         return "Unauthorized"
 
-    with open("diseases.json") as f:
-        diseases = json.load(f)
-
-    diseases = [d for d in diseases if d["name"] != name]
-
-    with open("diseases.json", "w") as f:
-        json.dump(diseases, f, indent=4)
+    disease_catalog.delete(name)
 
     return redirect("/admin")
 
@@ -672,16 +1794,30 @@ def admin_logout():
 def upgrade():
     return render_template("upgrade.html")
 
+RAZORPAY_TIMEOUT = float(os.getenv("RAZORPAY_TIMEOUT", "10"))
+razorpay_options = {}
+if os.getenv("RAZORPAY_BASE_URL"):
+    razorpay_options["base_url"] = os.getenv("RAZORPAY_BASE_URL")
+
 client = razorpay.Client(
-    auth=(os.getenv("RAZORPAY_KEY"), os.getenv("RAZORPAY_SECRET"))
+    auth=(os.getenv("RAZORPAY_KEY"), os.getenv("RAZORPAY_SECRET")),
+    **razorpay_options
 )
 
 @app.route("/create_order/<int:amount>")
 def create_order(amount):
-    order = client.order.create({
-        'amount': amount,
-        'currency': 'INR'
-    })
+    # bounded, so a stalled gateway can't hold a worker thread indefinitely
+    try:
+        order = client.order.create({
+            'amount': amount,
+            'currency': 'INR'
+        }, timeout=RAZORPAY_TIMEOUT)
+    except requests.RequestException:
+        return jsonify({"error": "payment gateway unavailable"}), 504
+    except razorpay.errors.BadRequestError as e:
+        return jsonify({"error": str(e)}), 400
+    except (razorpay.errors.GatewayError, razorpay.errors.ServerError) as e:
+        return jsonify({"error": str(e)}), 502
     return order
 
 @app.route("/payment_success")
@@ -696,7 +1832,7 @@ def payment_success():
 """, (user_id,))
 
     conn.commit()
-    conn.close()
+    update_entitlement(user_id, plan="PREMIUM", plan_expiry=None)
 
     flash("Payment successful! You are now Premium.", "success")
     return redirect(url_for("index"))
@@ -718,11 +1854,62 @@ def activate_plan(plan):
 
     return render_template("manual_payment.html", amount=amount, plan=plan_name)
 
+# ----- Payment screenshot storage -----
+def process_screenshot_later(digest):
+    # always off the request thread, whatever the serving mode
+    executors.io().submit(process_screenshot, digest).add_done_callback(_log_background_failure)
+
+
+def _send_screenshot_file(path, etag):
+    with open(path, "rb") as f:
+        mimetype = sniff_image_type(f.read(16)) or "application/octet-stream"
+    # content addressed and never rewritten, so it can be cached for good,
+    # but only privately
+    response = send_file(path, mimetype=mimetype, etag=etag, max_age=365 * 24 * 3600)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route("/admin/screenshots/<digest>")
+def admin_screenshot(digest):
+    if not session.get("admin_logged_in"):
+        return redirect("/admin_login")
+    if not DIGEST_RE.fullmatch(digest) or not os.path.exists(screenshot_path(digest)):
+        return "Not found", 404
+    return _send_screenshot_file(screenshot_path(digest), digest)
+
+
+@app.route("/admin/screenshots/<digest>/thumb")
+def admin_screenshot_thumb(digest):
+    if not session.get("admin_logged_in"):
+        return redirect("/admin_login")
+    if not DIGEST_RE.fullmatch(digest) or not os.path.exists(screenshot_path(digest)):
+        return "Not found", 404
+    thumb_path = thumbnail_path(digest)
+    if not os.path.exists(thumb_path):
+        # background job still queued (or failed): do it now
+        try:
+            process_screenshot(digest)
+        except (OSError, Image.DecompressionBombError, SyntaxError):
+            app.logger.exception("cannot make thumbnail for %s", digest)
+            response = app.response_class(THUMBNAIL_PLACEHOLDER, mimetype="image/svg+xml")
+            response.cache_control.no_store = True
+            return response
+    return _send_screenshot_file(thumb_path, f"{digest}-thumb")
+
+
 @app.route("/upload_payment", methods=["POST"])
 def upload_payment():
     if "user_id" not in session:
         return redirect(url_for("login"))
 
+    # refuse oversized uploads before the multipart body is parsed
+    if request.content_length and request.content_length > SCREENSHOT_MAX_BYTES + SCREENSHOT_CHUNK:
+        flash(f"Screenshot is too large (max {SCREENSHOT_MAX_BYTES // (1024 * 1024)} MB).", "error")
+        return redirect("/upgrade")
+
     user_id = session["user_id"]
     plan = request.form.get("plan")
     amount = request.form.get("amount")
@@ -734,22 +1921,21 @@ def upload_payment():
         return redirect("/upgrade")
 
     # Save screenshot
-    folder = "payment_screenshots"
-    os.makedirs(folder, exist_ok=True)
-
-    filename = f"{user_id}_{datetime.utcnow().timestamp()}.png"
-    filepath = os.path.join(folder, filename)
-    screenshot.save(filepath)
+    try:
+        digest = store_screenshot(screenshot.stream)
+    except ValueError as e:
+        flash(str(e), "error")
+        return redirect("/upgrade")
+    process_screenshot_later(digest)
 
     # Create pending payment entry
     conn = get_db_conn()
     cur = conn.cursor()
     cur.execute("""
-        INSERT INTO payments (user_id, amount, plan, timestamp, status)
-        VALUES (?, ?, ?, ?, 'PENDING')
-    """, (user_id, amount, plan, datetime.utcnow().isoformat()))
+        INSERT INTO payments (user_id, amount, plan, timestamp, status, screenshot)
+        VALUES (?, ?, ?, ?, 'PENDING', ?)
+    """, (user_id, amount, plan, datetime.utcnow().isoformat(), digest))
     conn.commit()
-    conn.close()
 
     # Notify admin via email (optional)
     flash("Your payment screenshot was submitted. Admin will verify within 24 hours.", "success")
@@ -761,16 +1947,51 @@ def admin_payments():
     if not session.get("admin_logged_in"):
         return redirect("/admin_login")
 
+    # newest first, keyset pagination on payments.id; optional status filter
+    # and username prefix search
+    status = request.args.get("status", "").upper()
+    search = request.args.get("q", "").strip()
+    before = request.args.get("before", type=int)
+
+    where = []
+    params = []
+    if status in ("PENDING", "APPROVED", "REJECTED"):
+        where.append("payments.status = ?")
+        params.append(status)
+    else:
+        status = ""
+    if search:
+        where.append("users.username >= ? AND users.username < ?")
+        params.extend(prefix_bounds(search))
+    if before is not None:
+        where.append("payments.id < ?")
+        params.append(before)
+
     conn = get_db_conn()
     cur = conn.cursor()
-    cur.execute("""
-        SELECT payments.id, users.username, payments.plan, payments.amount, payments.timestamp, payments.status
+    cur.execute(f"""
+        SELECT payments.id, users.username, payments.plan, payments.amount, payments.timestamp,
+               payments.status, payments.screenshot
         FROM payments
         JOIN users ON payments.user_id = users.id
+        {"WHERE " + " AND ".join(where) if where else ""}
         ORDER BY payments.id DESC
-    """)
+        LIMIT ?
+    """, (*params, ADMIN_PAGE_SIZE + 1))
     rows = cur.fetchall()
-    conn.close()
+    has_more = len(rows) > ADMIN_PAGE_SIZE
+    rows = rows[:ADMIN_PAGE_SIZE]
+
+    # how many payments use each screenshot on this page; a reused image is
+    # worth a second look before approving
+    digests = sorted({r[6] for r in rows if r[6]})
+    uses = {}
+    if digests:
+        uses = dict(conn.execute(f"""
+            SELECT screenshot, COUNT(*) FROM payments
+            WHERE screenshot IN ({", ".join("?" * len(digests))})
+            GROUP BY screenshot
+        """, digests).fetchall())
 
     payments = []
     for r in rows:
@@ -780,10 +2001,26 @@ def admin_payments():
             "plan": r[2],
             "amount": r[3],
             "timestamp": r[4],
-            "status": r[5]
+            "status": r[5],
+            "screenshot": r[6],
+            "screenshot_uses": uses.get(r[6], 0)
         })
 
-    return render_template("admin_payments.html", payments=payments)
+    next_page = None
+    if has_more:
+        next_page = url_for("admin_payments", status=status or None, q=search or None, before=rows[-1][0])
+
+    summary = admin_summary(conn)
+    return render_template(
+        "admin_payments.html",
+        payments=payments,
+        total=summary["total_revenue"],
+        pending=summary["pending_payments"],
+        status=status,
+        search=search,
+        next_page=next_page,
+        first_page=before is None
+    )
 
 @app.route("/admin/approve_payment/<int:payment_id>")
 def approve_payment(payment_id):
@@ -816,7 +2053,7 @@ def approve_payment(payment_id):
     cur.execute("UPDATE payments SET status='APPROVED' WHERE id=?", (payment_id,))
 
     conn.commit()
-    conn.close()
+    update_entitlement(user_id, plan=plan, plan_expiry=expiry)
 
     flash("Payment approved. User upgraded!", "success")
     return redirect("/admin_payments")
@@ -830,7 +2067,6 @@ def reject_payment(payment_id):
     cur = conn.cursor()
     cur.execute("UPDATE payments SET status='REJECTED' WHERE id=?", (payment_id,))
     conn.commit()
-    conn.close()
 
     flash("Payment rejected.", "info")
     return redirect("/admin_payments")
@@ -848,6 +2084,37 @@ def terms():
 def contact():
     return render_template("contact.html")
 
+def record_prediction(conn, user_id, is_paid, symptoms, predicted, health_score):
+    """Charge one free use (unless is_paid) and log the query; False if none were left."""
+    row_values = (user_id, datetime.utcnow().isoformat(), symptoms, predicted, health_score)
+    buffered = QUERY_LOG_MODE == "buffered"
+    try:
+        if not is_paid:
+            # check and decrement in one statement, so concurrent requests
+            # can't spend more than free_uses
+            row = conn.execute(
+                "UPDATE users SET free_uses = free_uses - 1 WHERE id=? AND free_uses > 0 RETURNING free_uses",
+                (user_id,)
+            ).fetchone()
+            if row is None:
+                conn.rollback()
+                update_entitlement(user_id, free_uses=0)
+                return False
+
+        if not buffered:
+            conn.execute(INSERT_QUERY_SQL, row_values)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    if buffered:
+        query_log.append(row_values, conn)
+    if not is_paid:
+        update_entitlement(user_id, free_uses=row[0])
+    return True
+
+
 @app.route("/predict", methods=["POST"])
 def predict():
     if "user_id" not in session:
@@ -856,16 +2123,13 @@ def predict():
 
     user_id = session["user_id"]
 
-    conn = get_db_conn()
-    cur = conn.cursor()
-
-    # Get free uses
-    cur.execute("SELECT free_uses FROM users WHERE id=?", (user_id,))
-    row = cur.fetchone()
-    free_left = row[0] if row else 0
+    # Get free uses and plan (cached per worker). This only saves scoring for
+    # users who are clearly out of quota; record_prediction has the final say.
+    entitlement = get_entitlement(user_id)
+    free_left = entitlement.free_uses
 
     # Check premium
-    is_paid = has_active_plan(user_id)
+    is_paid = entitlement.has_active_plan()
 
     # If user has no free predictions and no premium plan
     if free_left <= 0 and not is_paid:
@@ -873,47 +2137,199 @@ def predict():
         return redirect(url_for("upgrade"))
 
     text_input = request.form["symptoms"]
-    warnings, emergency_level = ai_emergency_check(text_input)
-
-    # LOAD diseases
-    with open("diseases.json", "r") as f:
-        diseases = json.load(f)
+    warnings, emergency_level = emergency_check_cached(text_input)
 
-    disease, score = ai_predict(text_input, diseases)
+    ranked = predict_cached(text_input, k=PREDICTION_TOP_K)
+    disease, score = ranked[0]
 
-    probability = round(score / 100 * 80 + 20)
+    probability = score_to_probability(score)
     health_score = 100 - probability
 
-    # Save query
-    cur.execute("""
-        INSERT INTO queries (user_id, timestamp, symptoms, predicted, health_score)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, datetime.utcnow().isoformat(), text_input, disease["name"], health_score))
-
-    # Decrease free uses if not premium
-    if not is_paid:
-        cur.execute("UPDATE users SET free_uses = free_uses - 1 WHERE id=?", (user_id,))
-
-    conn.commit()
-    conn.close()
+    # Spend a free use (unless premium) and save the query, atomically
+    if not record_prediction(get_db_conn(), user_id, is_paid, text_input, disease.name, health_score):
+        flash("Your free predictions are over. Please upgrade your plan.", "error")
+        return redirect(url_for("upgrade"))
 
     result = {
-        "name": disease["name"],
+        "name": disease.name,
         "probability": probability,
-        "severity": disease["severity"],
-        "medicine": disease["medicine"],
-        "precautions": disease["precautions"],
+        "severity": disease.severity,
+        "medicine": disease.medicine,
+        "precautions": disease.precautions,
         "health_score": health_score
     }
 
+    # other candidates for the differential diagnosis list
+    differential = [
+        {
+            "name": d.name,
+            "probability": score_to_probability(sc),
+            "severity": d.severity
+        }
+        for d, sc in differential_candidates(ranked)
+    ]
+
     return render_template(
         "result.html",
         result=result,
+        differential=differential,
         user_text=text_input,
         warnings=warnings,
         emergency_level=emergency_level
     )
 
+# ----- Batch triage -----
+
+# /predict/batch scores in the request worker (or its scoring pool, see
+# SCORING_PROCESSES) and stops at BATCH_MAX_ROWS rows or after
+# BATCH_TIME_LIMIT seconds, well inside gunicorn's 60 s timeout; larger
+# files go through "flask triage", which has its own process pool.
+BATCH_MAX_ROWS = int(os.getenv("BATCH_MAX_ROWS", "10000"))
+BATCH_TIME_LIMIT = float(os.getenv("BATCH_TIME_LIMIT", "40"))
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", str(os.cpu_count() or 1)))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "64"))
+BATCH_PROGRESS_EVERY = 500
+
+
+def score_to_probability(score):
+    return round(score / 100 * 80 + 20)
+
+
+def differential_candidates(ranked):
+    """Runners-up worth listing: ranked[1:] minus those below DIFFERENTIAL_MIN_SCORE."""
+    return [(d, sc) for d, sc in ranked[1:] if sc >= DIFFERENTIAL_MIN_SCORE]
+
+
+def triage_text(text):
+    """Emergency check + ranked prediction for one free-text description."""
+    warnings, emergency_level = emergency_check_cached(text)
+    ranked = predict_cached(text, k=PREDICTION_TOP_K)
+    if not ranked:
+        return {"emergency_level": emergency_level, "warnings": warnings, "predicted": None}
+
+    disease, score = ranked[0]
+    probability = score_to_probability(score)
+    return {
+        "emergency_level": emergency_level,
+        "warnings": warnings,
+        "predicted": disease.name,
+        "probability": probability,
+        "severity": disease.severity,
+        "health_score": 100 - probability,
+        "differential": [
+            {"name": d.name, "probability": score_to_probability(sc)}
+            for d, sc in differential_candidates(ranked)
+        ]
+    }
+
+
+def triage_chunk(rows):
+    """Worker-side: triage a list of (row id, text) pairs."""
+    return [dict(triage_text(text), id=row_id) for row_id, text in rows]
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def triage_stream(rows, pool=None, in_flight=4, chunk_size=BATCH_CHUNK_SIZE):
+    """Yield triage results for (row id, text) pairs, in completion order when pooled."""
+    if pool is None:
+        for chunk in _chunks(rows, chunk_size):
+            yield from triage_chunk(chunk)
+        return
+
+    pending = set()
+    for chunk in _chunks(rows, chunk_size):
+        pending.add(pool.submit(triage_chunk, chunk))
+        if len(pending) >= in_flight:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield from future.result()
+    for future in pending:
+        yield from future.result()
+
+
+def _until(rows, deadline):
+    for row in rows:
+        yield row
+        if time.monotonic() > deadline:
+            return
+
+
+def _jsonl_rows(lines, errors):
+    """(row id, text) pairs from JSON lines; bad lines are appended to errors."""
+    for number, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            errors.append({"id": number, "error": f"invalid JSON: {e}"})
+            continue
+        if isinstance(record, str):
+            yield number, record
+        elif isinstance(record, dict) and isinstance(record.get("symptoms", ""), str):
+            yield record.get("id", number), record.get("symptoms", "")
+        else:
+            errors.append({"id": number, "error": 'expected a string or {"id": ..., "symptoms": "..."}'})
+
+
+def _drain(errors):
+    while errors:
+        yield errors.pop(0)
+
+
+@app.route("/predict/batch", methods=["POST"])
+def predict_batch():
+    """Bulk triage: JSON lines in, JSON lines out (streamed as rows finish)."""
+    if not session.get("admin_logged_in"):
+        user_id = session.get("user_id")
+        if not user_id or not has_active_plan(user_id):
+            return jsonify({"error": "batch triage needs an active plan"}), 403
+
+    lines = request.stream
+    pool = executors.scoring() if offload_scoring() else None
+
+    def generate():
+        processed = emergencies = failed = 0
+        errors = []
+        rows = _jsonl_rows(lines, errors)
+        limited = _until(itertools.islice(rows, BATCH_MAX_ROWS), time.monotonic() + BATCH_TIME_LIMIT)
+        for result in triage_stream(limited, pool, in_flight=SCORING_PROCESSES * 2):
+            for error in _drain(errors):
+                failed += 1
+                yield json.dumps(error) + "\n"
+            processed += 1
+            emergencies += result["emergency_level"] == "HIGH"
+            yield json.dumps(result) + "\n"
+            if processed % BATCH_PROGRESS_EVERY == 0:
+                yield json.dumps({"progress": {"processed": processed, "high_risk": emergencies}}) + "\n"
+        for error in _drain(errors):
+            failed += 1
+            yield json.dumps(error) + "\n"
+
+        progress = {"processed": processed, "high_risk": emergencies, "errors": failed, "done": True}
+        # anything left over (even an unusable line) was cut off by the limits
+        if next(rows, None) is not None or errors:
+            progress["truncated"] = True
+            yield json.dumps({"error": f"batch stopped after {processed + failed} lines; the limit is "
+                                       f"{BATCH_MAX_ROWS} rows or {BATCH_TIME_LIMIT:g} s per request"}) + "\n"
+        yield json.dumps({"progress": progress}) + "\n"
+
+    return app.response_class(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 @app.route("/forgot_password", methods=["GET", "POST"])
 def forgot_password():
     if request.method == "POST":
@@ -923,7 +2339,6 @@ def forgot_password():
         cur = conn.cursor()
         cur.execute("SELECT security_question FROM users WHERE username=?", (username,))
         row = cur.fetchone()
-        conn.close()
 
         if not row:
             flash("Username not found", "error")
@@ -945,7 +2360,6 @@ def verify_answer():
     cur = conn.cursor()
     cur.execute("SELECT security_answer FROM users WHERE username=?", (username,))
     row = cur.fetchone()
-    conn.close()
 
     if row and check_password_hash(row[0], answer):
         return render_template("reset_password.html")
@@ -964,7 +2378,6 @@ def reset_password():
     cur = conn.cursor()
     cur.execute("UPDATE users SET password_hash=? WHERE username=?", (pw_hash, username))
     conn.commit()
-    conn.close()
 
     session.pop("reset_username", None)
 
@@ -980,6 +2393,67 @@ def service_worker():
     return send_from_directory('static', 'service_worker.js')
 
 
+# ----- CLI -----
+
+@app.cli.command("triage")
+@click.argument("input_file", type=click.File("r", encoding="utf-8"))
+@click.option("-o", "--output", type=click.File("w", encoding="utf-8"), default="-",
+              help="JSON lines output (default: stdout)")
+@click.option("--column", default="symptoms", help="CSV column holding the symptom text")
+@click.option("--id-column", default=None, help="CSV column to use as row id (default: row number)")
+@click.option("--workers", default=BATCH_WORKERS, show_default=True, type=int)
+def triage_command(input_file, output, column, id_column, workers):
+    """Bulk triage a CSV (or .jsonl) file of symptom descriptions."""
+    errors = []
+    if input_file.name.endswith((".jsonl", ".ndjson")):
+        rows = _jsonl_rows(input_file, errors)
+    else:
+        reader = csv.DictReader(input_file)
+        if column not in (reader.fieldnames or []):
+            raise click.BadParameter(f"no column {column!r} in {input_file.name}")
+        rows = (
+            (record[id_column] if id_column else number, record[column] or "")
+            for number, record in enumerate(reader, start=1)
+        )
+
+    processed = 0
+    started = time.perf_counter()
+    failed = 0
+    pool = None
+    if workers > 1:
+        # a CLI process runs no threads of its own, so forking it is safe
+        pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    with pool or nullcontext():
+        for result in triage_stream(rows, pool, in_flight=workers * 2):
+            for error in _drain(errors):
+                output.write(json.dumps(error) + "\n")
+                failed += 1
+            output.write(json.dumps(result) + "\n")
+            processed += 1
+            if processed % BATCH_PROGRESS_EVERY == 0:
+                rate = processed / (time.perf_counter() - started)
+                click.echo(f"{processed} rows ({rate:.0f}/s)", err=True)
+
+    for error in _drain(errors):
+        output.write(json.dumps(error) + "\n")
+        failed += 1
+    click.echo(f"done: {processed} rows in {time.perf_counter() - started:.1f}s"
+               + (f", {failed} invalid lines" if failed else ""), err=True)
+
+
+@app.cli.command("build-catalog")
+@click.option("--output", default=None, help="artifact path (default: CATALOG_ARTIFACT)")
+def build_catalog_command(output):
+    """Compile diseases.json into the memory-mapped catalog artifact."""
+    path = output or CATALOG_ARTIFACT
+    if not path:
+        raise click.UsageError("CATALOG_ARTIFACT is disabled; pass --output")
+    with open(DISEASES_PATH, "rb") as f:
+        raw = f.read()
+    header = compile_catalog(json.loads(raw.decode("utf-8")), hashlib.sha1(raw).hexdigest(), path)
+    click.echo(f"{header['count']} diseases -> {path} ({os.path.getsize(path)} bytes)")
+
+
 if __name__ == "__main__":
     app.run(debug=False)
 
@@ -0,0 +1,241 @@
+"""Benchmarks for the prediction and emergency hot paths.
+
+Builds synthetic disease catalogs of increasing size, runs realistic free-text
+symptom inputs through clean_text, ai_emergency_check, match_symptoms and
+ai_predict (once per scoring backend) and reports per-call latency
+percentiles, throughput and peak memory. Results are written as JSON so runs
+can be compared over time.
+
+    python benchmarks/bench_hotpaths.py
+    python benchmarks/bench_hotpaths.py --sizes 30 1000 100000 --calls 200
+    python benchmarks/bench_hotpaths.py --backends index cdist --output run.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+import app  # noqa: E402
+import symptom_index  # noqa: E402
+
+
+BODY_PARTS = ["chest", "stomach", "back", "joint", "muscle", "head", "neck", "eye", "ear",
+              "throat", "skin", "knee", "abdominal", "lower back", "leg", "arm"]
+QUALIFIERS = ["mild", "severe", "chronic", "sudden", "persistent", "recurring", "sharp", "dull"]
+FEELINGS = ["pain", "swelling", "itching", "burning", "numbness", "stiffness", "redness", "cramps"]
+TEMPLATES = [
+    "I have {a} and {b}",
+    "since yesterday {a}, {b} and some {c}",
+    "my child has {a} with {b}",
+    "{a} {b} {c}",
+    "feeling {a} for three days, also {b}",
+    "I think I have {a}. There is also {b} at night and {c} in the morning",
+]
+
+
+def build_symptom_vocab(base_symptoms, size, rng):
+    """Real catalog symptoms plus generated ones, so vocabulary grows with the catalog."""
+    vocab = list(dict.fromkeys(base_symptoms))
+    seen = set(vocab)
+    target = max(len(vocab), int(size ** 0.75) * 4)
+    misses = 0
+    while len(vocab) < target:
+        symptom = f"{rng.choice(QUALIFIERS)} {rng.choice(BODY_PARTS)} {rng.choice(FEELINGS)}"
+        if rng.random() < 0.3:
+            symptom = rng.choice(base_symptoms) + " " + rng.choice(FEELINGS)
+        if symptom in seen:
+            misses += 1
+            if misses < 100:
+                continue
+            # large catalogs use up every combination; number the variants
+            symptom = f"{symptom} type {len(vocab)}"
+        misses = 0
+        seen.add(symptom)
+        vocab.append(symptom)
+    return vocab
+
+
+def build_catalog(size, base_diseases, rng):
+    base_symptoms = [s.lower() for d in base_diseases for s in d["symptoms"]]
+    vocab = build_symptom_vocab(base_symptoms, size, rng)
+    catalog = []
+    for i in range(size):
+        template = base_diseases[i % len(base_diseases)]
+        catalog.append({
+            "name": f"{template['name']} #{i}",
+            "symptoms": rng.sample(vocab, rng.randint(3, 8)),
+            "medicine": template["medicine"],
+            "precautions": template["precautions"],
+            "severity": template["severity"],
+        })
+    return catalog, vocab
+
+
+def typo(word, rng):
+    if len(word) < 4 or rng.random() > 0.25:
+        return word
+    i = rng.randrange(1, len(word) - 1)
+    return word[:i] + word[i + 1:]
+
+
+def build_inputs(vocab, count, rng):
+    emergency = list(app.EMERGENCY_SYMPTOMS)
+    inputs = []
+    for _ in range(count):
+        picks = [rng.choice(vocab) for _ in range(3)]
+        if rng.random() < 0.2:
+            picks[rng.randrange(3)] = rng.choice(emergency)
+        text = rng.choice(TEMPLATES).format(a=picks[0], b=picks[1], c=picks[2])
+        inputs.append(" ".join(typo(w, rng) for w in text.split()))
+    return inputs
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def measure(fn, inputs, warmup=3):
+    """Run fn over inputs; return latency/throughput stats and traced peak memory."""
+    for text in inputs[:warmup]:
+        fn(text)
+
+    timings = []
+    gc.collect()
+    start = time.perf_counter()
+    for text in inputs:
+        t0 = time.perf_counter()
+        fn(text)
+        timings.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+
+    # memory is traced in a separate pass, tracemalloc distorts timings
+    gc.collect()
+    tracemalloc.start()
+    for text in inputs[:5]:
+        fn(text)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    ms = [t * 1000 for t in timings]
+    return {
+        "calls": len(inputs),
+        "mean_ms": statistics.fmean(ms),
+        "p50_ms": percentile(ms, 0.50),
+        "p90_ms": percentile(ms, 0.90),
+        "p99_ms": percentile(ms, 0.99),
+        "max_ms": ms[-1],
+        "throughput_per_s": len(inputs) / elapsed if elapsed else 0.0,
+        "peak_memory_kb": peak / 1024,
+    }
+
+
+def measure_index_build(catalog, backend):
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    symptom_index._symptom_indexes.pop(backend, None)
+    symptom_index.get_symptom_index(catalog, backend)
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"build_ms": elapsed * 1000, "peak_memory_kb": peak / 1024}
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    base = app.disease_catalog.snapshot()
+    results = {
+        "started": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": args.seed,
+        "calls": args.calls,
+        "sizes": {},
+    }
+
+    for size in args.sizes:
+        catalog, vocab = build_catalog(size, base, rng)
+        inputs = build_inputs(vocab, args.calls, rng)
+        size_result = {"vocabulary": len(vocab), "hotpaths": {}, "predict": {}}
+        print(f"\n== {size} diseases, {len(vocab)} distinct symptoms ==")
+
+        hotpaths = {
+            "clean_text": app.clean_text,
+            "ai_emergency_check": app.ai_emergency_check,
+            "ai_emergency_check_legacy": app.ai_emergency_check_legacy,
+        }
+        # match_symptoms against one disease, as called by the legacy scan
+        sample = [s.lower() for s in catalog[0]["symptoms"]]
+        hotpaths["match_symptoms"] = lambda text: symptom_index.match_symptoms(app.clean_text(text), sample)
+
+        for name, fn in hotpaths.items():
+            stats = measure(fn, inputs)
+            size_result["hotpaths"][name] = stats
+            report(name, stats)
+
+        for backend in args.backends:
+            if backend == "legacy" and size > args.legacy_max:
+                print(f"  {'ai_predict[legacy]':<28} skipped (> --legacy-max {args.legacy_max})")
+                continue
+            calls = inputs if backend != "legacy" else inputs[:max(5, len(inputs) // 10)]
+            build = measure_index_build(catalog, backend) if backend != "legacy" else None
+            stats = measure(lambda text: app.ai_predict(text, catalog, backend), calls)
+            stats["index"] = build
+            size_result["predict"][backend] = stats
+            report(f"ai_predict[{backend}]", stats)
+            if build:
+                print(f"  {'':<28} index build {build['build_ms']:.1f} ms, "
+                      f"{build['peak_memory_kb']:.0f} KB")
+
+        results["sizes"][str(size)] = size_result
+
+    return results
+
+
+def report(name, stats):
+    print(f"  {name:<28} p50 {stats['p50_ms']:8.3f} ms  p99 {stats['p99_ms']:8.3f} ms  "
+          f"{stats['throughput_per_s']:9.1f}/s  peak {stats['peak_memory_kb']:8.0f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[30, 1000, 10000, 100000])
+    parser.add_argument("--backends", nargs="+", default=["legacy", "index", "cdist"])
+    parser.add_argument("--calls", type=int, default=100, help="inputs per measurement")
+    parser.add_argument("--legacy-max", type=int, default=1000,
+                        help="skip the legacy backend above this catalog size")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="JSON results file "
+                        "(default: benchmarks/results/<timestamp>.json)")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    output = args.output or os.path.join(
+        APP_DIR, "benchmarks", "results",
+        f"hotpaths_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
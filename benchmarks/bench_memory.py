@@ -0,0 +1,98 @@
+"""Memory footprint of the disease catalog representations.
+
+Generates a synthetic catalog (100k diseases by default), serializes it to
+JSON like diseases.json, then measures the Python heap retained by:
+
+  * dicts   - json.loads output wrapped read-only, one dict per disease (the
+              original representation)
+  * Disease - __slots__ records with symptom ids into a shared SymptomVocab
+  * mmap    - the compiled artifact, untouched and after decoding every record
+
+    python benchmarks/bench_memory.py
+    python benchmarks/bench_memory.py --size 20000
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import MappingProxyType
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, "benchmarks"))
+
+import app  # noqa: E402
+from catalog import CompiledCatalog, Disease, SymptomVocab, compile_catalog  # noqa: E402
+from bench_hotpaths import build_catalog  # noqa: E402
+
+
+def retained(build):
+    """Return (result, bytes still allocated once build() returns, seconds)."""
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - t0
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def as_dicts(raw):
+    return tuple(
+        MappingProxyType(dict(d, symptoms=tuple(d["symptoms"])))
+        for d in json.loads(raw)
+    )
+
+
+def as_records(raw):
+    vocab = SymptomVocab()
+    return tuple(Disease.from_dict(d, vocab) for d in json.loads(raw))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1234)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    catalog, vocab = build_catalog(args.size, app.disease_catalog.snapshot(), rng)
+    raw = json.dumps(catalog)
+    del catalog
+    print(f"{args.size} diseases, {len(vocab)} distinct symptoms, {len(raw) / 1e6:.1f} MB of JSON")
+
+    rows = []
+    dicts, size, elapsed = retained(lambda: as_dicts(raw))
+    rows.append(("dicts", size, elapsed))
+    del dicts
+
+    records, size, elapsed = retained(lambda: as_records(raw))
+    rows.append(("Disease", size, elapsed))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "catalog.bin")
+        compile_catalog(records, hashlib.sha1(raw.encode("utf-8")).hexdigest(), path)
+        del records
+        compiled, size, elapsed = retained(lambda: CompiledCatalog(path))
+        rows.append(("mmap (untouched)", size, elapsed))
+        _, size, elapsed = retained(lambda: list(compiled))
+        rows.append(("mmap (all decoded)", size, elapsed))
+        print(f"artifact on disk: {os.path.getsize(path) / 1e6:.1f} MB (shared between workers)")
+        del compiled, _
+
+    baseline = rows[0][1]
+    for name, size, elapsed in rows:
+        print(f"  {name:<20} {size / 1e6:8.1f} MB  {size / args.size:7.0f} B/disease  "
+              f"{baseline / size if size else float('inf'):6.1f}x smaller  load {elapsed * 1000:7.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Throughput of the /predict write path: QUERY_LOG_MODE sync vs buffered.
+
+Threads, each on its own SQLite connection (as request threads would be),
+call app.record_prediction in a loop for premium users, so the only write
+is the query history row. In "sync" mode every call commits its own row;
+in "buffered" mode rows go through app.query_log and are committed in
+batches. Both run with PRAGMA synchronous=FULL by default to make each
+commit pay for an fsync, as it would on a slow disk.
+
+    python benchmarks/bench_query_log.py
+    python benchmarks/bench_query_log.py --threads 16 --calls 5000 --synchronous NORMAL
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, "benchmarks"))
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ["DB_PATH"] = os.path.join(_tmp.name, "query_log.db")
+
+import app  # noqa: E402
+from bench_hotpaths import percentile  # noqa: E402
+
+
+def run(mode, args):
+    app.QUERY_LOG_MODE = mode
+    app.QUERY_LOG_SYNCHRONOUS = args.synchronous
+    app.query_log = app.QueryLogWriter(args.batch, args.flush_ms / 1000, app.QUERY_LOG_MAX_PENDING)
+
+    setup = app._connect()
+    setup.execute("DELETE FROM queries")
+    setup.commit()
+
+    per_thread = args.calls // args.threads
+    latencies = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def worker(user_id):
+        conn = app._connect()
+        conn.execute(f"PRAGMA synchronous={args.synchronous}")
+        timings = []
+        barrier.wait()
+        for i in range(per_thread):
+            t0 = time.perf_counter()
+            app.record_prediction(conn, user_id, True, "fever,cough", "Flu", 50)
+            timings.append(time.perf_counter() - t0)
+        conn.close()
+        with lock:
+            latencies.extend(timings)
+
+    threads = [threading.Thread(target=worker, args=(i + 1,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    app.query_log.close()
+    drained = time.perf_counter() - start
+
+    logged = setup.execute("SELECT COUNT(*) FROM queries").fetchone()[0]
+    setup.close()
+    ms = sorted(t * 1000 for t in latencies)
+    return {
+        "calls": len(latencies),
+        "logged": logged,
+        "throughput_per_s": len(latencies) / elapsed,
+        "p50_ms": percentile(ms, 0.5),
+        "p99_ms": percentile(ms, 0.99),
+        "drain_ms": (drained - elapsed) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--calls", type=int, default=2000, help="record_prediction calls in total")
+    parser.add_argument("--batch", type=int, default=app.QUERY_LOG_BATCH)
+    parser.add_argument("--flush-ms", type=int, default=app.QUERY_LOG_FLUSH_MS)
+    parser.add_argument("--synchronous", default="FULL", choices=["FULL", "NORMAL", "OFF"])
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads, {args.calls} calls, synchronous={args.synchronous}")
+    for mode in ("sync", "buffered"):
+        r = run(mode, args)
+        print(f"  {mode:<9} {r['throughput_per_s']:9.0f} calls/s  p50 {r['p50_ms']:7.3f} ms  "
+              f"p99 {r['p99_ms']:7.3f} ms  logged {r['logged']}/{r['calls']}  "
+              f"shutdown flush {r['drain_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Concurrency check for the /predict quota write.
+
+Many threads, each on its own SQLite connection, spend the free predictions
+of one user at once. Two write paths are compared:
+
+  * legacy - the old sequence: SELECT free_uses, decide in Python, score,
+             INSERT the query, UPDATE free_uses - 1, COMMIT
+  * atomic - app.record_prediction: UPDATE ... WHERE free_uses > 0
+             RETURNING, INSERT, COMMIT
+
+For each it reports how many predictions were granted against the quota
+(anything above it is over-spend), the final free_uses, and how long each
+transaction held the write lock (from its first write returning to commit).
+
+    python benchmarks/bench_quota.py
+    python benchmarks/bench_quota.py --threads 32 --quota 50 --requests 400
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, os.path.join(APP_DIR, "benchmarks"))
+
+_tmp = tempfile.TemporaryDirectory()
+os.environ["DB_PATH"] = os.path.join(_tmp.name, "quota.db")
+
+import app  # noqa: E402
+from bench_hotpaths import percentile  # noqa: E402
+
+
+class TimedWrites:
+    """Connection proxy timing the write lock: first INSERT/UPDATE returning to commit."""
+
+    def __init__(self, conn, holds):
+        self._conn = conn
+        self._holds = holds
+        self._locked = None
+
+    def execute(self, sql, *args):
+        cursor = self._conn.execute(sql, *args)
+        if self._locked is None and sql.lstrip().split(None, 1)[0].upper() in ("INSERT", "UPDATE"):
+            self._locked = time.perf_counter()
+        return cursor
+
+    def commit(self):
+        self._conn.commit()
+        if self._locked is not None:
+            self._holds.append(time.perf_counter() - self._locked)
+        self._locked = None
+
+    def rollback(self):
+        self._conn.rollback()
+        self._locked = None
+
+
+def legacy_write(conn, user_id, scoring_s):
+    free_left = conn.execute("SELECT free_uses FROM users WHERE id=?", (user_id,)).fetchone()[0]
+    if free_left <= 0:
+        return False
+    time.sleep(scoring_s)
+    conn.execute(
+        "INSERT INTO queries (user_id, timestamp, symptoms, predicted, health_score) VALUES (?, ?, ?, ?, ?)",
+        (user_id, "t", "fever", "Flu", 50)
+    )
+    conn.execute("UPDATE users SET free_uses = free_uses - 1 WHERE id=?", (user_id,))
+    conn.commit()
+    return True
+
+
+def atomic_write(conn, user_id, scoring_s):
+    time.sleep(scoring_s)
+    return app.record_prediction(conn, user_id, False, "fever", "Flu", 50)
+
+
+def run(mode, args):
+    setup = app._connect()
+    setup.execute("DELETE FROM queries")
+    setup.execute("DELETE FROM users")
+    user_id = setup.execute(
+        "INSERT INTO users (username, password_hash, free_uses) VALUES ('quota', 'x', ?) RETURNING id",
+        (args.quota,)
+    ).fetchone()[0]
+    setup.commit()
+
+    write = legacy_write if mode == "legacy" else atomic_write
+    granted = []
+    hold = []
+    per_thread = args.requests // args.threads
+    barrier = threading.Barrier(args.threads)
+
+    def worker():
+        raw = app._connect()
+        conn = TimedWrites(raw, hold)
+        barrier.wait()
+        for _ in range(per_thread):
+            if write(conn, user_id, args.scoring_ms / 1000):
+                granted.append(1)
+        raw.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    app.query_log.flush()
+
+    free_left = setup.execute("SELECT free_uses FROM users WHERE id=?", (user_id,)).fetchone()[0]
+    logged = setup.execute("SELECT COUNT(*) FROM queries WHERE user_id=?", (user_id,)).fetchone()[0]
+    setup.close()
+    hold_ms = sorted(h * 1000 for h in hold)
+    return {
+        "granted": len(granted),
+        "over_spend": max(0, len(granted) - args.quota),
+        "free_uses_after": free_left,
+        "queries_logged": logged,
+        "hold_mean_ms": statistics.fmean(hold_ms) if hold_ms else 0.0,
+        "hold_p99_ms": percentile(hold_ms, 0.99),
+        "elapsed_s": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--quota", type=int, default=20, help="free predictions the user starts with")
+    parser.add_argument("--requests", type=int, default=160, help="prediction attempts in total")
+    parser.add_argument("--scoring-ms", type=float, default=2.0,
+                        help="simulated scoring time between the quota check and the write")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads, {args.requests} attempts, quota {args.quota}")
+    for mode in ("legacy", "atomic"):
+        r = run(mode, args)
+        print(f"  {mode:<7} granted {r['granted']:4d}  over-spend {r['over_spend']:4d}  "
+              f"free_uses after {r['free_uses_after']:4d}  logged {r['queries_logged']:4d}  "
+              f"lock held mean {r['hold_mean_ms']:.3f} ms p99 {r['hold_p99_ms']:.3f} ms  "
+              f"{r['elapsed_s']:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+"""Concurrent load test: sync vs threaded gunicorn serving modes.
+
+Starts the app under gunicorn (gunicorn.conf.py) once per serving mode, each
+with its own scratch database and the same number of workers, plus a local
+stand-in for the Razorpay API that answers after --upstream-delay seconds.
+Logged-in clients then hammer a mix of /predict (CPU + SQLite writes) and
+/create_order (waits on the payment gateway) and the script reports
+throughput and latency percentiles per mode.
+
+    python benchmarks/load_test.py
+    python benchmarks/load_test.py --requests 2000 --concurrency 64 --workers 2
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SYMPTOMS = ["fever", "cough", "headache", "nausea", "chest pain", "rash", "fatigue",
+            "joint pain", "sore throat", "runny nose", "vomiting", "dizziness", "back pain"]
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_fake_gateway(delay):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(delay)
+            body = json.dumps({"id": f"order_{random.getrandbits(32):x}", "status": "created"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_server(mode, workers, port, db_path, gateway_url):
+    env = dict(
+        os.environ,
+        SERVING_MODE=mode,
+        WEB_CONCURRENCY=str(workers),
+        DB_PATH=db_path,
+        SECRET_KEY="load-test",
+        RAZORPAY_BASE_URL=gateway_url,
+        RAZORPAY_KEY="rzp_test",
+        RAZORPAY_SECRET="secret",
+        PREDICTION_CACHE_SIZE="0",      # measure scoring, not the cache
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+         "--bind", f"127.0.0.1:{port}", "--access-logfile", "/dev/null", "app:app"],
+        cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(150):
+        try:
+            urllib.request.urlopen(base + "/login", timeout=1).read()
+            return proc, base
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"gunicorn ({mode}) did not come up")
+
+
+def logged_in_opener(base, db_path):
+    """Register a premium user straight into the scratch DB and log in."""
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    username = f"load{random.getrandbits(32):x}"
+    form = {"username": username, "password": "pw", "security_question": "q", "security_answer": "a"}
+    opener.open(base + "/register", urllib.parse.urlencode(form).encode()).read()
+    with sqlite3.connect(db_path) as conn:
+        expiry = (datetime.utcnow() + timedelta(days=1)).isoformat()
+        conn.execute("UPDATE users SET plan='MONTHLY', plan_expiry=? WHERE username=?", (expiry, username))
+    opener.open(base + "/login", urllib.parse.urlencode({"username": username, "password": "pw"}).encode()).read()
+    return opener
+
+
+def run_load(base, opener, total, concurrency, order_share, rng):
+    jobs = []
+    for _ in range(total):
+        if rng.random() < order_share:
+            jobs.append(("create_order", base + "/create_order/9900", None))
+        else:
+            text = ", ".join(rng.sample(SYMPTOMS, 3))
+            jobs.append(("predict", base + "/predict", urllib.parse.urlencode({"symptoms": text}).encode()))
+
+    latencies = {"predict": [], "create_order": []}
+    errors = 0
+    lock = threading.Lock()
+
+    def call(job):
+        nonlocal errors
+        kind, url, data = job
+        t0 = time.perf_counter()
+        try:
+            with opener.open(url, data, timeout=60) as resp:
+                resp.read()
+                ok = resp.status == 200
+        except OSError:
+            ok = False
+        elapsed = time.perf_counter() - t0
+        with lock:
+            latencies[kind].append(elapsed * 1000)
+            errors += not ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, jobs))
+    wall = time.perf_counter() - start
+
+    result = {"requests": total, "errors": errors, "wall_s": wall, "throughput_per_s": total / wall}
+    for kind, values in latencies.items():
+        values.sort()
+        result[kind] = {"p50_ms": percentile(values, 0.5), "p99_ms": percentile(values, 0.99)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["sync", "threaded"])
+    parser.add_argument("--workers", type=int, default=2, help="gunicorn workers, same for every mode")
+    parser.add_argument("--requests", type=int, default=600)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--order-share", type=float, default=0.5,
+                        help="fraction of requests that go to /create_order")
+    parser.add_argument("--upstream-delay", type=float, default=0.2,
+                        help="seconds the fake payment gateway takes to answer")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="write results as JSON")
+    args = parser.parse_args()
+
+    gateway = start_fake_gateway(args.upstream_delay)
+    gateway_url = f"http://127.0.0.1:{gateway.server_address[1]}/v1"
+    results = {}
+
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "load.db")
+            proc, base = start_server(mode, args.workers, free_port(), db_path, gateway_url)
+            try:
+                opener = logged_in_opener(base, db_path)
+                run_load(base, opener, min(20, args.requests), args.concurrency,
+                         args.order_share, random.Random(0))   # warm up
+                result = run_load(base, opener, args.requests, args.concurrency,
+                                  args.order_share, random.Random(args.seed))
+            finally:
+                proc.terminate()
+                proc.wait(timeout=30)
+        results[mode] = result
+        print(f"{mode:<9} {result['throughput_per_s']:8.1f} req/s  "
+              f"predict p50 {result['predict']['p50_ms']:7.1f} ms p99 {result['predict']['p99_ms']:7.1f} ms  "
+              f"create_order p50 {result['create_order']['p50_ms']:7.1f} ms  errors {result['errors']}")
+
+    gateway.shutdown()
+    if "sync" in results and "threaded" in results:
+        speedup = results["threaded"]["throughput_per_s"] / results["sync"]["throughput_per_s"]
+        print(f"threaded / sync throughput: {speedup:.2f}x")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,618 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections import namedtuple
+from collections.abc import Mapping, Sequence
+from contextlib import contextmanager
+
+from storage import fsync_dir, write_file_atomic
+from tokenizer import TOKENIZER, content_words
+
+try:
+    import fcntl
+except ImportError:     # not POSIX: catalog writers only serialize within one process
+    fcntl = None
+
+APP_DIR = os.path.dirname(__file__)
+
+logger = logging.getLogger(__name__)
+
+
+class SymptomVocab:
+    """Lowercased symptom strings shared by a whole catalog; a symptom's id is its position."""
+
+    __slots__ = ("strings", "_ids")
+
+    def __init__(self, strings=()):
+        self.strings = list(strings)
+        self._ids = None
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, sid):
+        return self.strings[sid]
+
+    def intern(self, symptom):
+        """Return the id of symptom, adding it if it is new."""
+        if self._ids is None:
+            self._ids = {s: i for i, s in enumerate(self.strings)}
+        symptom = sys.intern(symptom.lower())
+        sid = self._ids.get(symptom)
+        if sid is None:
+            sid = self._ids[symptom] = len(self.strings)
+            self.strings.append(symptom)
+        return sid
+
+
+def _intern_text(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Disease(Mapping):
+    """Read-only catalog entry whose symptoms are ids into a shared SymptomVocab."""
+
+    FIELDS = ("name", "symptoms", "medicine", "precautions", "severity")
+    __slots__ = ("name", "symptom_ids", "medicine", "precautions", "severity", "vocab", "labels")
+
+    def __init__(self, name, symptom_ids, medicine, precautions, severity, vocab, labels=None):
+        self.name = name
+        self.symptom_ids = symptom_ids
+        self.medicine = medicine
+        self.precautions = precautions
+        self.severity = severity
+        self.vocab = vocab
+        # symptoms as written in diseases.json, if not just the vocabulary strings
+        self.labels = labels
+
+    @classmethod
+    def from_dict(cls, disease, vocab=None):
+        """Build a record from a diseases.json entry, interning into vocab."""
+        vocab = vocab if vocab is not None else SymptomVocab()
+        raw = tuple(disease.get("symptoms", ()))
+        symptom_ids = tuple(dict.fromkeys(vocab.intern(s) for s in raw))
+        return cls(
+            disease.get("name"),
+            symptom_ids,
+            _intern_text(disease.get("medicine")),
+            _intern_text(disease.get("precautions")),
+            _intern_text(disease.get("severity")),
+            vocab,
+            symptom_labels(raw, symptom_ids, vocab.strings)
+        )
+
+    @property
+    def symptoms(self):
+        if self.labels is not None:
+            return self.labels
+        strings = self.vocab.strings
+        return tuple(strings[sid] for sid in self.symptom_ids)
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __eq__(self, other):
+        if isinstance(other, Disease):
+            return (self.name, self.symptoms, self.medicine, self.precautions, self.severity) == \
+                (other.name, other.symptoms, other.medicine, other.precautions, other.severity)
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Disease({self.name!r}, symptoms={self.symptoms!r})"
+
+
+def symptom_labels(raw, symptom_ids, strings):
+    """raw (interned) if it isn't just the vocabulary strings of symptom_ids, else None."""
+    if len(raw) == len(symptom_ids) and all(s == strings[sid] for s, sid in zip(raw, symptom_ids)):
+        return None
+    return tuple(_intern_text(s) for s in raw)
+
+
+def shared_vocab(diseases):
+    """The SymptomVocab every record in diseases uses, or None if there isn't one."""
+    vocab = None
+    for disease in diseases:
+        if not isinstance(disease, Disease) or (vocab is not None and disease.vocab is not vocab):
+            return None
+        vocab = disease.vocab
+    return vocab
+
+
+def build_symptom_tables(diseases):
+    """Return (symptom strings, symptom ids per disease) for a disease list."""
+    shared = shared_vocab(diseases)
+    if shared is not None:
+        return list(shared.strings), [disease.symptom_ids for disease in diseases]
+
+    vocab = []
+    disease_symptoms = []
+
+    ids = {}
+    for disease in diseases:
+        symptom_ids = []
+        for symptom in disease["symptoms"]:
+            symptom = symptom.lower()
+            sid = ids.get(symptom)
+            if sid is None:
+                sid = ids[symptom] = len(vocab)
+                vocab.append(symptom)
+            if sid not in symptom_ids:
+                symptom_ids.append(sid)
+        disease_symptoms.append(tuple(symptom_ids))
+    return vocab, disease_symptoms
+
+
+# ----- Compiled catalog artifact -----
+# "flask build-catalog" compiles diseases.json into one file holding the
+# pre-normalized symptom vocabulary, phrase keys, the symptom <-> disease
+# tables and the disease records. Workers mmap it read-only, so all of them
+# share the same pages instead of each parsing JSON and building the index.
+# It is keyed on the sha1 of diseases.json and simply ignored when stale;
+# set CATALOG_ARTIFACT="" to disable it.
+
+CATALOG_ARTIFACT = os.getenv("CATALOG_ARTIFACT", os.path.join(APP_DIR, "diseases.bin"))
+CATALOG_MAGIC = b"HMCAT\x00\x00\x01"
+CATALOG_FORMAT = 4
+
+
+class Ragged(Sequence):
+    """Rows of unsigned ints stored flat: row i is values[offsets[i]:offsets[i + 1]]."""
+
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+
+def _pack_strings(strings):
+    blob = bytearray()
+    offsets = array("Q", [0])
+    for string in strings:
+        blob += string.encode("utf-8")
+        offsets.append(len(blob))
+    return bytes(blob), offsets
+
+
+def _pack_ragged(rows):
+    values = array("I")
+    offsets = array("Q", [0])
+    for row in rows:
+        values.extend(row)
+        offsets.append(len(values))
+    return values, offsets
+
+
+def compile_catalog(diseases, source_digest, path):
+    """Write the compiled artifact for diseases (atomically, via a temp file)."""
+    vocab, disease_symptoms = build_symptom_tables(diseases)
+    phrase_keys = [" ".join(content_words(symptom)) for symptom in vocab]
+    # symptoms live in disease_symptoms; records keep the remaining fields,
+    # plus the symptoms as written when they differ from the vocabulary
+    records = []
+    for d, symptom_ids in zip(diseases, disease_symptoms):
+        record = [d["medicine"], d["precautions"], d["severity"]]
+        labels = symptom_labels(tuple(d["symptoms"]), symptom_ids, vocab)
+        if labels is not None:
+            record.append(labels)
+        records.append(json.dumps(record, ensure_ascii=False))
+
+    sections = {}
+    sections["vocab"], sections["vocab_offsets"] = _pack_strings(vocab)
+    sections["phrases"], sections["phrases_offsets"] = _pack_strings(phrase_keys)
+    sections["names"], sections["names_offsets"] = _pack_strings([d["name"] for d in diseases])
+    sections["records"], sections["records_offsets"] = _pack_strings(records)
+    sections["disease_symptoms"], sections["disease_symptoms_offsets"] = _pack_ragged(disease_symptoms)
+
+    header = {
+        "format": CATALOG_FORMAT,
+        "source_sha1": source_digest,
+        "tokenizer": TOKENIZER,
+        "byteorder": sys.byteorder,
+        "count": len(diseases),
+        "sections": {}
+    }
+    # section offsets depend on the header length, so lay out against a
+    # generous fixed header size
+    header_size = 4096
+    offset = len(CATALOG_MAGIC) + 4 + header_size
+    for name, data in sections.items():
+        typecode = data.typecode if isinstance(data, array) else "B"
+        nbytes = len(data) * (data.itemsize if isinstance(data, array) else 1)
+        header["sections"][name] = [offset, nbytes, typecode]
+        offset += nbytes + (-nbytes % 8)     # keep every section 8-byte aligned
+    header_bytes = json.dumps(header).encode("utf-8")
+    if len(header_bytes) > header_size:
+        raise ValueError("catalog header too large")
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(CATALOG_MAGIC + struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes.ljust(header_size, b"\x00"))
+        for name, data in sections.items():
+            raw = data.tobytes() if isinstance(data, array) else data
+            f.write(raw + b"\x00" * (-len(raw) % 8))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+    return header
+
+
+class CompiledCatalog(Sequence):
+    """Read-only disease catalog backed by a memory-mapped artifact."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._map)
+        if bytes(buf[:len(CATALOG_MAGIC)]) != CATALOG_MAGIC:
+            raise ValueError(f"{path} is not a compiled catalog")
+        (header_len,) = struct.unpack_from("<I", buf, len(CATALOG_MAGIC))
+        start = len(CATALOG_MAGIC) + 4
+        self.header = json.loads(bytes(buf[start:start + header_len]))
+        self.digest = self.header["source_sha1"]
+        self._sections = {}
+        for name, (offset, nbytes, typecode) in self.header["sections"].items():
+            view = buf[offset:offset + nbytes]
+            self._sections[name] = view.cast(typecode) if typecode != "B" else view
+        self._records = [None] * self.header["count"]
+        self._vocab = None
+
+    @property
+    def vocab(self):
+        if self._vocab is None:
+            self._vocab = SymptomVocab(self.strings("vocab"))
+        return self._vocab
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        record = self._records[i]
+        if record is None:
+            medicine, precautions, severity, *labels = json.loads(self.strings("records", i))
+            symptom_ids = tuple(self.ragged("disease_symptoms")[i])
+            record = self._records[i] = Disease(
+                self.strings("names", i), symptom_ids,
+                _intern_text(medicine), _intern_text(precautions), _intern_text(severity),
+                self.vocab, tuple(map(_intern_text, labels[0])) if labels else None
+            )
+        return record
+
+    def strings(self, name, i=None):
+        """All strings of a string section, or just the i-th one."""
+        blob, offsets = self._sections[name], self._sections[f"{name}_offsets"]
+        if i is not None:
+            return str(blob[offsets[i]:offsets[i + 1]], "utf-8")
+        text = bytes(blob)
+        return [text[offsets[j]:offsets[j + 1]].decode("utf-8") for j in range(len(offsets) - 1)]
+
+    def ragged(self, name):
+        return Ragged(self._sections[f"{name}_offsets"], self._sections[name])
+
+
+def load_compiled_catalog(path, source_digest):
+    """The artifact at path for this diseases.json content, or None if missing or stale."""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        catalog = CompiledCatalog(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    header = catalog.header
+    if (header.get("format") != CATALOG_FORMAT or header.get("source_sha1") != source_digest
+            or header.get("tokenizer") != TOKENIZER or header.get("byteorder") != sys.byteorder):
+        return None
+    return catalog
+
+
+# ----- Catalog edit log -----
+# Admin edits are appended to diseases.log, one JSON line per operation,
+# instead of rewriting diseases.json. The first line names the sha1 of the
+# diseases.json the log applies to, so a log left over from before a
+# compaction is recognized and ignored. Every CATALOG_COMPACT_EVERY edits the
+# log is folded back into diseases.json (temp file + rename), the artifact is
+# recompiled and a fresh log is started. Writers serialize on a lock file.
+
+CATALOG_LOG_PATH = os.path.join(APP_DIR, "diseases.log")
+CATALOG_COMPACT_EVERY = int(os.getenv("CATALOG_COMPACT_EVERY", "200"))
+
+
+class CatalogOverlay(Sequence):
+    """A snapshot made from an older one by applying logged edits."""
+
+    def __init__(self, root, refs, extra, vocab, parent, changes):
+        self.root = root
+        self.refs = refs
+        self.extra = extra
+        self.vocab = vocab
+        self.parent = parent
+        self.changes = changes   # [("add" | "update" | "delete", position, Disease or None)]
+
+    def __len__(self):
+        return len(self.refs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        ref = self.refs[i]
+        return self.root[ref] if ref >= 0 else self.extra[-1 - ref]
+
+    def names(self):
+        root_names = snapshot_names(self.root)
+        return [root_names[ref] if ref >= 0 else self.extra[-1 - ref].name for ref in self.refs]
+
+
+def snapshot_names(snapshot):
+    if isinstance(snapshot, CompiledCatalog):
+        return snapshot.strings("names")
+    if isinstance(snapshot, CatalogOverlay):
+        return snapshot.names()
+    return [d.name for d in snapshot]
+
+
+def apply_catalog_ops(snapshot, vocab, ops):
+    """Return a CatalogOverlay of snapshot with the logged ops applied."""
+    if isinstance(snapshot, CatalogOverlay):
+        root, refs, extra = snapshot.root, array("q", snapshot.refs), list(snapshot.extra)
+        # only one step of history is kept, so old snapshots can be freed
+        snapshot.parent = None
+    else:
+        root, refs, extra = snapshot, array("q", range(len(snapshot))), []
+    names = snapshot_names(snapshot)
+    changes = []
+
+    for op in ops:
+        kind = op.get("op")
+        if kind == "add":
+            disease = Disease.from_dict(op["disease"], vocab)
+            changes.append(("add", len(refs), disease))
+            refs.append(-1 - len(extra))
+            extra.append(disease)
+            names.append(disease.name)
+        elif kind == "update":
+            if op["name"] not in names:
+                continue
+            position = names.index(op["name"])
+            disease = Disease.from_dict(op["disease"], vocab)
+            changes.append(("update", position, disease))
+            refs[position] = -1 - len(extra)
+            extra.append(disease)
+            names[position] = disease.name
+        elif kind == "delete":
+            # back to front, so each recorded position is valid when applied
+            for position in reversed([i for i, name in enumerate(names) if name == op["name"]]):
+                changes.append(("delete", position, None))
+                del refs[position]
+                del names[position]
+
+    return CatalogOverlay(root, refs, tuple(extra), vocab, snapshot, changes)
+
+
+_CatalogState = namedtuple(
+    "_CatalogState", "key base_digest snapshot version root vocab log_inode log_offset"
+)
+
+
+class DiseaseCatalog:
+    """diseases.json plus its edit log, as immutable per-worker snapshots."""
+
+    def __init__(self, path, log_path, artifact=CATALOG_ARTIFACT):
+        self.path = path
+        self.log_path = log_path
+        self.artifact = artifact
+        self.lock_path = f"{path}.lock"
+        self._lock = threading.Lock()
+        self._local_write_lock = threading.Lock()
+        self._state = _CatalogState(None, None, (), 0, (), None, None, 0)
+        self._names = None      # (snapshot, name -> position), built on first find()
+
+    def _stat_key(self):
+        st = os.stat(self.path)
+        try:
+            log = os.stat(self.log_path)
+            log_key = (log.st_ino, log.st_size)
+        except FileNotFoundError:
+            log_key = None
+        return (st.st_mtime_ns, st.st_size, log_key)
+
+    def snapshot(self):
+        """Return the current catalog as a sequence of Disease records."""
+        key = self._stat_key()
+        if key != self._state.key:
+            self._reload(key)
+        return self._state.snapshot
+
+    @property
+    def version(self):
+        """Increases by one every time the catalog content changes."""
+        self.snapshot()
+        return self._state.version
+
+    @property
+    def digest(self):
+        """Identifies the catalog content: diseases.json sha1 plus how much of the log is applied."""
+        self.snapshot()
+        return f"{self._state.base_digest}:{self._state.log_offset}"
+
+    def snapshot_with_version(self):
+        """Return (snapshot, version) taken from the same catalog load."""
+        self.snapshot()
+        state = self._state
+        return state.snapshot, state.version
+
+    def invalidate(self):
+        """Force the next snapshot() to re-check the files (after a local write)."""
+        with self._lock:
+            self._state = self._state._replace(key=None)
+
+    def _reload(self, key):
+        with self._lock:
+            state = self._state
+            if key == state.key:
+                return
+            if state.key is None or key[:2] != state.key[:2]:
+                with open(self.path, "rb") as f:
+                    raw = f.read()
+                digest = hashlib.sha1(raw).hexdigest()
+                if digest != state.base_digest:
+                    root = load_compiled_catalog(self.artifact, digest)
+                    if root is None:
+                        vocab = SymptomVocab()
+                        root = tuple(Disease.from_dict(d, vocab) for d in json.loads(raw.decode("utf-8")))
+                    else:
+                        vocab = root.vocab
+                    state = _CatalogState(None, digest, root, state.version + 1, root, vocab, None, 0)
+
+            snapshot, version = state.snapshot, state.version
+            log_inode = key[2][0] if key[2] else None
+            offset = state.log_offset
+            if log_inode != state.log_inode or (key[2] and key[2][1] < offset):
+                # a new or truncated log: replay it on the root snapshot
+                offset = 0
+                if snapshot is not state.root:
+                    snapshot, version = state.root, version + 1
+
+            ops, offset = self._read_log(state.base_digest, offset)
+            if ops:
+                snapshot, version = apply_catalog_ops(snapshot, state.vocab, ops), version + 1
+            self._state = state._replace(
+                key=key, snapshot=snapshot, version=version, log_inode=log_inode, log_offset=offset
+            )
+
+    def _read_log(self, base_digest, offset):
+        """Return (ops past offset, new offset); ([], 0) if there is no log for this base."""
+        try:
+            with open(self.log_path, "rb") as f:
+                header = f.readline()
+                try:
+                    if json.loads(header).get("base") != base_digest:
+                        return [], 0
+                except ValueError:
+                    return [], 0
+                f.seek(max(offset, len(header)))
+                data = f.read()
+        except FileNotFoundError:
+            return [], 0
+
+        # a line without its newline is still being written; leave it for next time
+        complete = data[:data.rfind(b"\n") + 1]
+        ops = []
+        for line in complete.splitlines():
+            try:
+                ops.append(json.loads(line))
+            except ValueError:
+                logger.warning("skipping unreadable catalog log line: %r", line[:80])
+        return ops, max(offset, len(header)) + len(complete)
+
+    @contextmanager
+    def _write_lock(self):
+        # serializes writers across threads and gunicorn workers
+        with self._local_write_lock, open(self.lock_path, "a") as lock_file:
+            if fcntl is None:
+                yield
+                return
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def find(self, name):
+        """The disease called name in the current snapshot, or None."""
+        snapshot = self.snapshot()
+        names = self._names
+        if names is None or names[0] is not snapshot:
+            positions = {}
+            for position, disease_name in enumerate(snapshot_names(snapshot)):
+                positions.setdefault(disease_name, position)
+            names = self._names = (snapshot, positions)
+        position = names[1].get(name)
+        return snapshot[position] if position is not None else None
+
+    def load_mutable(self):
+        """Return a fresh, editable list of disease dicts."""
+        return [dict(d, symptoms=list(d["symptoms"])) for d in self.snapshot()]
+
+    # -- writes --
+
+    def add(self, disease):
+        self._append({"op": "add", "disease": disease})
+
+    def update(self, name, disease):
+        """Replace the first disease called name, keeping its position."""
+        self._append({"op": "update", "name": name, "disease": disease})
+
+    def delete(self, name):
+        """Remove every disease called name."""
+        self._append({"op": "delete", "name": name})
+
+    def _append(self, op):
+        line = json.dumps(op, ensure_ascii=False).encode("utf-8") + b"\n"
+        with self._write_lock():
+            self.snapshot()
+            if self._state.log_offset == 0:
+                # no log for the current diseases.json yet (or only a stale one)
+                self._start_log(self._state.base_digest)
+            with open(self.log_path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.snapshot()
+            if self._log_entries() >= CATALOG_COMPACT_EVERY:
+                self._compact()
+
+    def _log_entries(self):
+        with open(self.log_path, "rb") as f:
+            return sum(1 for _ in f) - 1
+
+    def _start_log(self, base_digest):
+        header = json.dumps({"base": base_digest}).encode("utf-8") + b"\n"
+        write_file_atomic(self.log_path, header)
+
+    def compact(self):
+        """Fold the edit log into diseases.json (and the artifact)."""
+        with self._write_lock():
+            self.snapshot()
+            self._compact()
+
+    def _compact(self):
+        self._write_base(self.load_mutable())
+
+    def save(self, diseases):
+        """Replace the whole catalog."""
+        with self._write_lock():
+            self._write_base(diseases)
+
+    def _write_base(self, diseases):
+        raw = json.dumps(diseases, indent=4).encode("utf-8")
+        digest = hashlib.sha1(raw).hexdigest()
+        if self.artifact:
+            compile_catalog(diseases, digest, self.artifact)
+        write_file_atomic(self.path, raw)
+        # the old log names the old base, so from here on it is ignored
+        self._start_log(digest)
+        self.invalidate()
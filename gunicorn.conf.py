@@ -0,0 +1,42 @@
+"""Gunicorn settings for HealMatrix.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Defaults to SERVING_MODE=threaded: a few gthread workers with several
+threads each, so a request waiting on SQLite, Razorpay or a report render
+only ties up one thread. SERVING_MODE=sync restores classic sync workers.
+Everything can be overridden with the usual GUNICORN_CMD_ARGS / env vars.
+"""
+import multiprocessing
+import os
+
+# the app reads the same variable to decide whether to offload scoring
+serving_mode = os.environ.setdefault("SERVING_MODE", "threaded")
+cpus = multiprocessing.cpu_count()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+if serving_mode == "threaded":
+    worker_class = "gthread"
+    # threads cover I/O waits, so a few workers are enough
+    workers = int(os.getenv("WEB_CONCURRENCY", str(max(2, cpus))))
+    threads = int(os.getenv("GUNICORN_THREADS", "8"))
+else:
+    worker_class = "sync"
+    workers = int(os.getenv("WEB_CONCURRENCY", str(cpus * 2 + 1)))
+    threads = 1
+
+# PDF renders and the first index build on a large catalog can take a while
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = 30
+keepalive = 5
+
+# parse the catalog once in the master; workers share those pages after fork
+preload_app = True
+# recycle workers now and then so slow leaks can't accumulate
+max_requests = 2000
+max_requests_jitter = 200
+# heartbeat files on tmpfs, not a possibly slow disk
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+accesslog = "-"
@@ -0,0 +1,131 @@
+import hashlib
+import io
+import os
+import re
+import threading
+
+from PIL import Image, ImageOps
+
+APP_DIR = os.path.dirname(__file__)
+
+
+def write_file_atomic(path, data):
+    """Replace path with data so that a crash leaves either the old or the new file."""
+    tmp_path = f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(path)
+
+
+def fsync_dir(path):
+    """Make a rename into path's directory durable (a no-op where dirs can't be opened)."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Screenshots are content addressed: stored once, unmodified, under the
+# SHA-256 of the uploaded bytes (<dir>/ab/abcd...), so re-uploads of the same
+# image share one file, payments.screenshot just holds the hash and the
+# bytes behind a URL never change. A background job writes a small WEBP
+# thumbnail for the admin review page.
+SCREENSHOT_DIR = os.getenv("SCREENSHOT_DIR", os.path.join(APP_DIR, "payment_screenshots"))
+SCREENSHOT_MAX_BYTES = int(os.getenv("SCREENSHOT_MAX_BYTES", str(10 * 1024 * 1024)))
+SCREENSHOT_CHUNK = 64 * 1024
+THUMBNAIL_SIZE = (320, 320)
+# shown instead of a thumbnail that can't be made (corrupt or oversized image)
+THUMBNAIL_PLACEHOLDER = (
+    '<svg xmlns="http://www.w3.org/2000/svg" width="320" height="200" viewBox="0 0 320 200">'
+    '<rect width="320" height="200" fill="#eee"/>'
+    '<text x="160" y="105" font-family="sans-serif" font-size="16" text-anchor="middle" fill="#888">'
+    'No preview</text></svg>'
+)
+
+DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def sniff_image_type(head):
+    """MIME type of an upload from its first bytes, or None if not an accepted image."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return None
+
+
+def screenshot_path(digest):
+    return os.path.join(SCREENSHOT_DIR, digest[:2], digest)
+
+
+def thumbnail_path(digest):
+    return os.path.join(SCREENSHOT_DIR, "thumbs", digest[:2], f"{digest}.webp")
+
+
+def store_screenshot(stream):
+    """Copy an upload into the store and return its SHA-256; ValueError if it is rejected."""
+    os.makedirs(SCREENSHOT_DIR, exist_ok=True)
+    tmp_path = os.path.join(SCREENSHOT_DIR, f".upload.tmp{os.getpid()}_{threading.get_ident()}")
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            while True:
+                chunk = stream.read(SCREENSHOT_CHUNK)
+                if not chunk:
+                    break
+                if size == 0 and sniff_image_type(chunk[:16]) is None:
+                    raise ValueError("Please upload a PNG, JPEG, WEBP or GIF screenshot.")
+                size += len(chunk)
+                if size > SCREENSHOT_MAX_BYTES:
+                    raise ValueError(f"Screenshot is too large (max {SCREENSHOT_MAX_BYTES // (1024 * 1024)} MB).")
+                sha.update(chunk)
+                f.write(chunk)
+        if size == 0:
+            raise ValueError("The uploaded screenshot is empty.")
+
+        digest = sha.hexdigest()
+        final_path = screenshot_path(digest)
+        if not os.path.exists(final_path):
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path)
+    finally:
+        remove_quietly(tmp_path)
+    return digest
+
+
+def process_screenshot(digest):
+    """Write the thumbnail of a stored screenshot (idempotent)."""
+    thumb_path = thumbnail_path(digest)
+    if os.path.exists(thumb_path):
+        return thumb_path
+    with Image.open(screenshot_path(digest)) as im:
+        im = ImageOps.exif_transpose(im)
+        im = im.convert("RGB")
+
+    im.thumbnail(THUMBNAIL_SIZE)
+    buffer = io.BytesIO()
+    im.save(buffer, "WEBP", quality=75)
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    write_file_atomic(thumb_path, buffer.getvalue())
+    return thumb_path
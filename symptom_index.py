@@ -0,0 +1,309 @@
+import copy
+import heapq
+import os
+import threading
+from collections import OrderedDict
+
+from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz as rapid_fuzz
+from rapidfuzz import process as rapid_process
+
+from catalog import CatalogOverlay, CompiledCatalog, Ragged, build_symptom_tables
+from tokenizer import content_words
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Score multi-word catalog symptoms found verbatim in the input without
+# fuzzy-scoring them (index/cdist backends); rankings are the same either way.
+PHRASE_MATCHING = os.getenv("PHRASE_MATCHING", "1") == "1"
+# rapidfuzz cdist workers for the cdist backend; -1 uses every core
+SCORING_WORKERS = int(os.getenv("SCORING_WORKERS", "1"))
+
+TOKEN_SCORE_CACHE_SIZE = 4096
+MAX_SCORE = 100     # partial_ratio upper bound
+MIN_PHRASE_WORDS = 2
+UNSCORED = 255      # marker in token score rows
+
+
+def match_symptoms(user_symptoms, disease_sym_list):
+    score = 0
+    for u in user_symptoms:
+        for d in disease_sym_list:
+            similarity = fuzz.partial_ratio(u, d)
+            score = max(score, similarity)
+    return score
+
+
+def rank_positions_legacy(user_symptoms, diseases, k=3):
+    scored = []
+    for position, disease in enumerate(diseases):
+        disease_sym_list = [s.lower() for s in disease["symptoms"]]
+        scored.append((position, match_symptoms(user_symptoms, disease_sym_list)))
+
+    scored.sort(key=lambda pair: -pair[1])   # stable: ties keep catalog order
+    return scored[:k]
+
+
+class SymptomIndex:
+    """Scores each user token once per distinct catalog symptom instead of once per disease."""
+    # token scores are cached per token (LRU); multi-word symptoms found
+    # verbatim in the input score MAX_SCORE without fuzzy scoring
+
+    def __init__(self, diseases):
+        self.source = diseases
+        if isinstance(diseases, CompiledCatalog):
+            # tables are views into the memory-mapped artifact, nothing to build
+            self.diseases = diseases
+            self.vocab = diseases.strings("vocab")
+            self.disease_symptoms = diseases.ragged("disease_symptoms")
+            phrase_keys = [tuple(key.split()) for key in diseases.strings("phrases")]
+        else:
+            self.diseases = diseases if isinstance(diseases, CatalogOverlay) else list(diseases)
+            self.vocab, self.disease_symptoms = build_symptom_tables(self.diseases)
+            phrase_keys = [tuple(content_words(symptom)) for symptom in self.vocab]
+
+        # n-gram lookup: symptom content words (as clean_text would produce
+        # them from the input) -> symptom ids
+        self.phrases = {}
+        self.max_phrase_len = 0
+        for sid, words in enumerate(phrase_keys):
+            if len(words) >= MIN_PHRASE_WORDS:
+                self.phrases.setdefault(words, []).append(sid)
+                self.max_phrase_len = max(self.max_phrase_len, len(words))
+
+        self._rows = OrderedDict()
+        self._rows_lock = threading.Lock()
+
+    def matches(self, diseases):
+        if diseases is self.source:
+            return True
+        snapshots = (CompiledCatalog, CatalogOverlay)
+        if isinstance(diseases, snapshots) or isinstance(self.source, snapshots):
+            # catalog snapshots are never compared element by element
+            return (isinstance(diseases, CompiledCatalog) and isinstance(self.source, CompiledCatalog)
+                    and diseases.digest == self.source.digest)
+        return list(diseases) == self.diseases
+
+    def token_row(self, token):
+        """Scores of token against every symptom, filled in on first use."""
+        with self._rows_lock:
+            row = self._rows.get(token)
+            if row is None:
+                row = self._rows[token] = bytearray([UNSCORED]) * len(self.vocab)
+                if len(self._rows) > TOKEN_SCORE_CACHE_SIZE:
+                    self._rows.popitem(last=False)
+            else:
+                self._rows.move_to_end(token)
+                if len(row) < len(self.vocab):
+                    # shared with an older index; symptoms were added since
+                    row.extend(bytes([UNSCORED]) * (len(self.vocab) - len(row)))
+        return row
+
+    def extract_phrases(self, user_symptoms):
+        """Ids of the multi-word symptoms found verbatim in the tokens (greedy, longest first)."""
+        matched = set()
+        if not PHRASE_MATCHING or not self.phrases:
+            return matched
+
+        i = 0
+        while i < len(user_symptoms):
+            for n in range(min(self.max_phrase_len, len(user_symptoms) - i), MIN_PHRASE_WORDS - 1, -1):
+                sids = self.phrases.get(tuple(user_symptoms[i:i + n]))
+                if sids:
+                    matched.update(sids)
+                    i += n
+                    break
+            else:
+                i += 1
+        return matched
+
+    def _scorer(self, user_symptoms):
+        """Return score(sid): best score of any user token against that symptom."""
+        matched = self.extract_phrases(user_symptoms)
+        tokens = list(set(user_symptoms))
+        rows = [self.token_row(token) for token in tokens]
+        vocab = self.vocab
+
+        def score(sid):
+            if sid in matched:
+                return MAX_SCORE
+            best = 0
+            for token, row in zip(tokens, rows):
+                value = row[sid]
+                if value == UNSCORED:
+                    value = row[sid] = fuzz.partial_ratio(token, vocab[sid])
+                if value > best:
+                    best = value
+            return best
+
+        return score
+
+    def symptom_scores(self, user_symptoms):
+        """Best score of any user token against each symptom in the vocabulary."""
+        score = self._scorer(user_symptoms)
+        return [score(sid) for sid in range(len(self.vocab))]
+
+    def top_matches(self, user_symptoms, k):
+        """Return up to k (disease position, score) pairs, best first."""
+        if k <= 0:
+            return []
+
+        score = self._scorer(user_symptoms)
+        heap = []   # min-heap of (score, -position): weakest, then latest, on top
+
+        for position, symptom_ids in enumerate(self.disease_symptoms):
+            full = len(heap) == k
+            if full and heap[0][0] >= MAX_SCORE:
+                break   # later diseases can only tie
+
+            disease_score = 0
+            for sid in symptom_ids:
+                value = score(sid)
+                if value > disease_score:
+                    disease_score = value
+                    if disease_score >= MAX_SCORE:
+                        break
+
+            if not full:
+                heapq.heappush(heap, (disease_score, -position))
+            elif disease_score > heap[0][0]:
+                heapq.heapreplace(heap, (disease_score, -position))
+
+        return [(-neg_position, value) for value, neg_position in sorted(heap, reverse=True)]
+
+    def best_match(self, user_symptoms):
+        """Return (disease position, score) of the best disease, or (None, -1)."""
+        ranked = self.top_matches(user_symptoms, 1)
+        return ranked[0] if ranked else (None, -1)
+
+    def patched(self, overlay):
+        """A new index for overlay, derived from this one (built for overlay.parent)."""
+        # symptom ids never change, so the cached token rows stay valid and are shared
+        index = copy.copy(self)
+        index.source = index.diseases = overlay
+        index.vocab = list(overlay.vocab.strings)
+
+        index.phrases = dict(self.phrases)
+        for sid in range(len(self.vocab), len(index.vocab)):
+            words = tuple(content_words(index.vocab[sid]))
+            if len(words) >= MIN_PHRASE_WORDS:
+                index.phrases[words] = index.phrases.get(words, []) + [sid]
+                index.max_phrase_len = max(index.max_phrase_len, len(words))
+
+        disease_symptoms = list(self.disease_symptoms)
+        for kind, position, disease in overlay.changes:
+            if kind == "add":
+                disease_symptoms.append(disease.symptom_ids)
+            elif kind == "update":
+                disease_symptoms[position] = disease.symptom_ids
+            else:
+                del disease_symptoms[position]
+        index.disease_symptoms = disease_symptoms
+        return index
+
+
+# ---------------- VECTORIZED SCORING (rapidfuzz.process.cdist) ----------------
+
+class CdistSymptomIndex(SymptomIndex):
+    """Scores the whole token x symptom matrix in one rapidfuzz cdist call."""
+    # rapidfuzz's partial_ratio can differ by a few points from fuzzywuzzy's
+    # on near-misses, so this backend is opt-in (SCORING_BACKEND=cdist)
+
+    def __init__(self, diseases, workers=1):
+        super().__init__(diseases)
+        self.workers = workers
+
+        width = max((len(ids) for ids in self.disease_symptoms), default=0)
+        self.membership = np.full(
+            (len(self.disease_symptoms), max(width, 1)), len(self.vocab), dtype=np.int32
+        )
+        if isinstance(self.disease_symptoms, Ragged):
+            # scatter the flat artifact table in one go
+            offsets = np.frombuffer(self.disease_symptoms.offsets, dtype=np.uint64).astype(np.int64)
+            lengths = np.diff(offsets)
+            rows = np.repeat(np.arange(len(lengths)), lengths)
+            cols = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+            self.membership[rows, cols] = np.frombuffer(self.disease_symptoms.values, dtype=np.uint32)
+        else:
+            for position, symptom_ids in enumerate(self.disease_symptoms):
+                self.membership[position, :len(symptom_ids)] = symptom_ids
+
+    def patched(self, overlay):
+        index = super().patched(overlay)
+        membership = self.membership
+        pad = len(index.vocab)
+        if pad != len(self.vocab):
+            membership = np.where(membership == len(self.vocab), pad, membership)
+        else:
+            membership = membership.copy()
+
+        for kind, position, disease in overlay.changes:
+            if kind == "delete":
+                membership = np.delete(membership, position, axis=0)
+                continue
+            ids = disease.symptom_ids
+            if len(ids) > membership.shape[1]:
+                extra = np.full((membership.shape[0], len(ids) - membership.shape[1]), pad, dtype=np.int32)
+                membership = np.hstack([membership, extra])
+            row = np.full(membership.shape[1], pad, dtype=np.int32)
+            row[:len(ids)] = ids
+            if kind == "add":
+                membership = np.vstack([membership, row])
+            else:
+                membership[position] = row
+        index.membership = membership
+        return index
+
+    def symptom_scores(self, user_symptoms):
+        # last slot is the padding column and always stays 0
+        scores = np.zeros(len(self.vocab) + 1, dtype=np.uint8)
+        matched = self.extract_phrases(user_symptoms)
+        tokens = list(dict.fromkeys(user_symptoms))
+        if tokens and self.vocab:
+            matrix = rapid_process.cdist(
+                tokens, self.vocab,
+                scorer=rapid_fuzz.partial_ratio,
+                dtype=np.uint8,
+                workers=self.workers
+            )
+            scores[:-1] = matrix.max(axis=0)
+        if matched:
+            scores[list(matched)] = MAX_SCORE
+        return scores
+
+    def top_matches(self, user_symptoms, k):
+        if k <= 0 or not self.disease_symptoms:
+            return []
+
+        disease_scores = self.symptom_scores(user_symptoms)[self.membership].max(axis=1)
+        if k == 1:
+            order = [int(disease_scores.argmax())]   # first maximum, like the legacy scan
+        else:
+            order = np.argsort(-disease_scores.astype(np.int16), kind="stable")[:k]
+        return [(int(position), int(disease_scores[position])) for position in order]
+
+
+_symptom_indexes = {}
+
+
+def get_symptom_index(diseases, backend="index"):
+    """Return the index for this disease list, rebuilding it if the catalog changed."""
+    if backend == "cdist" and np is None:
+        backend = "index"
+
+    index = _symptom_indexes.get(backend)
+    if index is not None and not index.matches(diseases):
+        parent = getattr(diseases, "parent", None)
+        if parent is not None and index.matches(parent):
+            # a catalog edit: patch instead of rebuilding
+            index = _symptom_indexes[backend] = index.patched(diseases)
+    if index is None or not index.matches(diseases):
+        if backend == "cdist":
+            index = CdistSymptomIndex(diseases, workers=SCORING_WORKERS)
+        else:
+            index = SymptomIndex(diseases)
+        _symptom_indexes[backend] = index
+    return index
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# keep the suite away from the real database and compiled catalog
+_tmp = tempfile.mkdtemp(prefix="healmatrix-tests-")
+os.environ["DB_PATH"] = os.path.join(_tmp, "test.db")
+os.environ["CATALOG_ARTIFACT"] = ""
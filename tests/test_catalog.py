@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import shutil
+
+import pytest
+
+import catalog
+import symptom_index
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+INPUTS = [
+    "chest pain",
+    "fever cough headache",
+    "shortness of breath and chest pain",
+    "night sweats and weight loss",
+    "purple toes, cold feet",
+    "",
+]
+
+EDITS = [
+    ("add", {"name": "Chilblains", "symptoms": ["Purple toes", "cold feet", "itching", "cold feet"],
+             "medicine": "Warming", "precautions": "Keep warm", "severity": "Low"}),
+    ("update", "Dengue", {"name": "Dengue", "symptoms": ["high fever", "pain behind the eyes", "rash"],
+                          "medicine": "Fluids", "precautions": "Rest", "severity": "High"}),
+    ("delete", "Common Cold"),
+    ("add", {"name": "Frostnip", "symptoms": ["cold feet", "numb fingers"],
+             "medicine": "Warming", "precautions": "Gloves", "severity": "Low"}),
+]
+
+
+@pytest.fixture(params=["json", "artifact"])
+def disease_catalog(request, tmp_path):
+    path = tmp_path / "diseases.json"
+    shutil.copy(os.path.join(ROOT, "diseases.json"), path)
+    artifact = str(tmp_path / "diseases.bin") if request.param == "artifact" else ""
+    if artifact:
+        with open(path, "rb") as f:
+            raw = f.read()
+        catalog.compile_catalog(json.loads(raw), hashlib.sha1(raw).hexdigest(), artifact)
+    return catalog.DiseaseCatalog(str(path), str(tmp_path / "diseases.log"), artifact=artifact)
+
+
+def apply_edit(disease_catalog, edit):
+    if edit[0] == "add":
+        disease_catalog.add(edit[1])
+    elif edit[0] == "update":
+        disease_catalog.update(edit[1], edit[2])
+    else:
+        disease_catalog.delete(edit[1])
+
+
+def symptom_rows(index):
+    return [[index.vocab[sid] for sid in ids] for ids in index.disease_symptoms]
+
+
+def phrase_table(index):
+    # a patched vocabulary keeps symptoms no disease uses any more; they can't affect scores
+    used = {sid for ids in index.disease_symptoms for sid in ids}
+    table = {}
+    for words, sids in index.phrases.items():
+        symptoms = sorted(index.vocab[sid] for sid in sids if sid in used)
+        if symptoms:
+            table[words] = symptoms
+    return table
+
+
+def as_dicts(snapshot):
+    return [dict(d, symptoms=list(d["symptoms"])) for d in snapshot]
+
+
+@pytest.mark.parametrize("backend", ["index", "cdist"])
+def test_patched_index_matches_fresh_build(disease_catalog, backend):
+    if backend == "cdist" and symptom_index.np is None:
+        pytest.skip("numpy is not installed")
+    index_class = symptom_index.CdistSymptomIndex if backend == "cdist" else symptom_index.SymptomIndex
+    index = index_class(disease_catalog.snapshot())
+
+    for edit in EDITS:
+        apply_edit(disease_catalog, edit)
+        snapshot = disease_catalog.snapshot()
+        assert isinstance(snapshot, catalog.CatalogOverlay)
+        index = index.patched(snapshot)
+        fresh = index_class(as_dicts(snapshot))
+
+        assert symptom_rows(index) == symptom_rows(fresh)
+        assert phrase_table(index) == phrase_table(fresh)
+        for text in INPUTS:
+            tokens = catalog.content_words(text)
+            assert index.top_matches(tokens, len(snapshot)) == fresh.top_matches(tokens, len(snapshot))
+
+
+def test_edit_log_matches_rebuilt_catalog(disease_catalog):
+    expected = as_dicts(disease_catalog.snapshot())
+    for edit in EDITS:
+        apply_edit(disease_catalog, edit)
+        if edit[0] == "add":
+            expected.append(edit[1])
+        elif edit[0] == "update":
+            position = [d["name"] for d in expected].index(edit[1])
+            expected[position] = edit[2]
+        else:
+            expected = [d for d in expected if d["name"] != edit[1]]
+    assert as_dicts(disease_catalog.snapshot()) == expected
+
+    disease_catalog.compact()
+    compacted = disease_catalog.snapshot()
+    assert not isinstance(compacted, catalog.CatalogOverlay)
+    assert as_dicts(compacted) == expected
+    # a fresh reader of the same files sees the same catalog
+    reader = catalog.DiseaseCatalog(disease_catalog.path, disease_catalog.log_path,
+                                    artifact=disease_catalog.artifact)
+    assert as_dicts(reader.snapshot()) == expected
@@ -0,0 +1,43 @@
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("mode", ["sync", "buffered"])
+def test_concurrent_predictions_never_overspend(monkeypatch, mode):
+    monkeypatch.setattr(app, "QUERY_LOG_MODE", mode)
+    quota, threads, attempts = 5, 8, 4
+
+    conn = app._connect()
+    user_id = conn.execute(
+        "INSERT INTO users (username, password_hash, free_uses) VALUES (?, 'x', ?) RETURNING id",
+        (f"quota-{mode}", quota)
+    ).fetchone()[0]
+    conn.commit()
+
+    granted = []
+    barrier = threading.Barrier(threads)
+
+    def worker():
+        worker_conn = app._connect()
+        barrier.wait()
+        for _ in range(attempts):
+            if app.record_prediction(worker_conn, user_id, False, "fever", "Flu", 50):
+                granted.append(1)
+        worker_conn.close()
+
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    app.query_log.flush()
+
+    free_uses = conn.execute("SELECT free_uses FROM users WHERE id=?", (user_id,)).fetchone()[0]
+    logged = conn.execute("SELECT COUNT(*) FROM queries WHERE user_id=?", (user_id,)).fetchone()[0]
+    conn.close()
+    assert len(granted) == quota
+    assert free_uses == 0
+    assert logged == quota
@@ -0,0 +1,46 @@
+import pytest
+
+import app
+import symptom_index
+
+INPUTS = [
+    "cough",
+    "chest pain",
+    "fever cough headache",
+    "I have a high fever and a bad cough since 3 days.",
+    "shortness of breath and chest pain",
+    "blood in urine",
+    "long cough, night sweats and weight loss",
+    "burning urination, frequent urination",
+    "loss of taste and fatigue",
+    "yellow eyes dark urine",
+    "itchy eyes, sneezing, runny nose",
+    "joint pain and rash",
+    "stomach ache",
+    "feeling dizzy",
+    "",
+]
+
+
+@pytest.fixture
+def diseases():
+    return app.disease_catalog.snapshot()
+
+
+@pytest.mark.parametrize("phrase_matching", [True, False])
+@pytest.mark.parametrize("text", INPUTS)
+def test_index_matches_legacy_scan(monkeypatch, diseases, text, phrase_matching):
+    monkeypatch.setattr(symptom_index, "PHRASE_MATCHING", phrase_matching)
+    tokens = app.clean_text(text)
+    index = symptom_index.get_symptom_index(diseases, "index")
+    for k in (1, 3, len(diseases)):
+        assert index.top_matches(tokens, k) == symptom_index.rank_positions_legacy(tokens, diseases, k)
+
+
+def test_single_word_symptoms_are_not_phrases(diseases):
+    index = symptom_index.get_symptom_index(diseases, "index")
+    assert all(len(words) >= 2 for words in index.phrases)
+    # "chest pain" is a phrase, but "pain" must still reach "joint pain"
+    scores = dict(index.top_matches(app.clean_text("chest pain"), len(diseases)))
+    names = [d.name for d in diseases]
+    assert scores[names.index("Dengue")] == 100
@@ -0,0 +1,48 @@
+"""The builtin tokenizer against token lists recorded from NLTK.
+
+tests/data/tokenizer_golden.json holds realistic symptom inputs with the
+tokens clean_text got for them from NLTK's word_tokenize and stopword list.
+The test needs no NLTK. To re-record after adding inputs (needs nltk):
+
+    python tests/test_tokenizer.py
+"""
+import json
+import os
+
+import pytest
+
+import tokenizer
+
+GOLDEN_PATH = os.path.join(os.path.dirname(__file__), "data", "tokenizer_golden.json")
+
+with open(GOLDEN_PATH, encoding="utf-8") as f:
+    GOLDEN = json.load(f)
+
+
+@pytest.mark.parametrize("case", GOLDEN, ids=[case["text"][:30] for case in GOLDEN])
+def test_builtin_tokenizer_matches_nltk(monkeypatch, case):
+    monkeypatch.setattr(tokenizer, "TOKENIZER", "builtin")
+    assert tokenizer.content_words(case["text"]) == case["tokens"]
+
+
+def nltk_tokens(text):
+    """clean_text's filtering over NLTK's word_tokenize (untrained Punkt if
+    the punkt data isn't installed)."""
+    from nltk.tokenize import NLTKWordTokenizer, PunktSentenceTokenizer
+
+    text = text.lower()
+    try:
+        words = tokenizer.tokenize_nltk(text)
+    except LookupError:
+        words = [w for sentence in PunktSentenceTokenizer().tokenize(text)
+                 for w in NLTKWordTokenizer().tokenize(sentence)]
+    stop_words = tokenizer.nltk_stop_words()
+    return [w for w in words if w.isalpha() and w not in stop_words]
+
+
+if __name__ == "__main__":
+    for case in GOLDEN:
+        case["tokens"] = nltk_tokens(case["text"])
+    with open(GOLDEN_PATH, "w", encoding="utf-8") as f:
+        json.dump(GOLDEN, f, indent=2, ensure_ascii=False)
+        f.write("\n")
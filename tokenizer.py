@@ -0,0 +1,119 @@
+import os
+import re
+
+APP_DIR = os.path.dirname(__file__)
+
+# "builtin" (default, no NLTK needed) or "nltk" (word_tokenize; needs
+# "pip install nltk" and the punkt data in nltk_data)
+TOKENIZER = os.getenv("TOKENIZER", "builtin")
+
+# NLTK's English stopword list, frozen so tokenizing needs no nltk_data
+STOP_WORDS = frozenset("""
+i me my myself we our ours ourselves you you're you've you'll you'd your yours
+yourself yourselves he him his himself she she's her hers herself it it's its
+itself they them their theirs themselves what which who whom this that that'll
+these those am is are was were be been being have has had having do does did
+doing a an the and but if or because as until while of at by for with about
+against between into through during before after above below to from up down
+in out on off over under again further then once here there when where why how
+all any both each few more most other some such no nor not only own same so
+than too very s t can will just don don't should should've now d ll m o re ve
+y ain aren aren't couldn couldn't didn didn't doesn doesn't hadn hadn't hasn
+hasn't haven haven't isn isn't ma mightn mightn't mustn mustn't needn needn't
+shan shan't shouldn shouldn't wasn wasn't weren weren't won won't wouldn
+wouldn't
+""".split())
+
+# The Treebank rules that matter for alphabetic tokens, applied in NLTK's
+# order: a quote before a single letter, "," / ":" unless a digit follows
+# ("3,000", "10:30"), then punctuation that is always split off.
+_QUOTE_LETTER = re.compile(r"'(?![mtsdn])(\w)\b")
+_COMMA_COLON = re.compile(r"([:,])([^\d])|([:,])$")
+_SPLIT_PUNCT = re.compile(r"""[;@#$%&?!*()\[\]{}<>"`«»“”‘’„]|\.{2,}|--""")
+# a period that may end a sentence: before whitespace, the end of the text
+# or punctuation (Punkt's sentence-end contexts)
+_PERIOD = re.compile(r"""(?<!\.)\.(?=[\])}>"'»”’]*(?:\s|$)|[)";}\]*:@'({\[!?])""")
+_WORD_BEFORE = re.compile(r"\w+$")
+_LOWER_WORD_AFTER = re.compile(r"\s+[^\W\d_]")
+
+
+def _split_final_period(match):
+    """Split off a period that Punkt would treat as a sentence end."""
+    text, start = match.string, match.start()
+    before = _WORD_BEFORE.search(text, 0, start)
+    if before and (before.group().isdigit() or (len(before.group()) == 1 and before.group().isalpha())):
+        after = _LOWER_WORD_AFTER.match(text, start + 1)
+        if after and after.group()[-1].islower():
+            return "."
+    return " "
+
+
+# Treebank splits these words in two (CONTRACTIONS2/3)
+_SPLIT_WORDS = {
+    "cannot": ("can", "not"), "gimme": ("gim", "me"), "gonna": ("gon", "na"),
+    "gotta": ("got", "ta"), "lemme": ("lem", "me"), "wanna": ("wan", "na"),
+    "d'ye": ("d", "'ye"), "more'n": ("more", "'n"), "'tis": ("'t", "is"), "'twas": ("'t", "was"),
+}
+_CLITICS = ("n't", "'ll", "'re", "'ve", "'s", "'m", "'d", "'")
+
+
+def _split_word(word):
+    """Apply Treebank's word-level splits: clitics, then contractions."""
+    tail = []
+    for clitic in _CLITICS:
+        if word.endswith(clitic) and len(word) > len(clitic) and word[-len(clitic) - 1] != "'":
+            word, tail = word[:-len(clitic)], [clitic]
+            break
+    return list(_SPLIT_WORDS.get(word, (word,))) + tail
+
+
+def tokenize_builtin(text):
+    """Regex tokenizer giving the same words as NLTK's word_tokenize for
+    everything clean_text keeps (alphabetic tokens)."""
+    text = _PERIOD.sub(_split_final_period, text)
+    text = _QUOTE_LETTER.sub(r"' \1", text)
+    text = _COMMA_COLON.sub(lambda m: " " + (m.group(2) or ""), text)
+    tokens = []
+    for word in _SPLIT_PUNCT.sub(" ", text).split():
+        tokens.extend(_split_word(word))
+    return tokens
+
+
+_nltk_word_tokenize = None
+_nltk_stop_words = None
+
+
+def tokenize_nltk(text):
+    """NLTK's word_tokenize, imported on first use."""
+    global _nltk_word_tokenize
+    if _nltk_word_tokenize is None:
+        import nltk
+        nltk.data.path.append(os.path.join(APP_DIR, "nltk_data"))
+        from nltk.tokenize import word_tokenize
+        _nltk_word_tokenize = word_tokenize
+    return _nltk_word_tokenize(text)
+
+
+def nltk_stop_words():
+    """NLTK's stopword corpus if installed, otherwise the bundled copy."""
+    global _nltk_stop_words
+    if _nltk_stop_words is None:
+        try:
+            from nltk.corpus import stopwords
+            _nltk_stop_words = frozenset(stopwords.words("english"))
+        except LookupError:
+            _nltk_stop_words = STOP_WORDS
+    return _nltk_stop_words
+
+
+def content_words(text):
+    """Lowercased, stopword-free alphabetic words of text."""
+    text = text.lower()
+    if TOKENIZER == "nltk":
+        words = tokenize_nltk(text)
+        stop_words = nltk_stop_words()
+    else:
+        words = tokenize_builtin(text)
+        stop_words = STOP_WORDS
+    words = [w for w in words if w.isalpha() and w not in stop_words]
+    return words